@@ -4,4 +4,9 @@ from .utils import (
     get_reprojected_vector_layer,
 )
 from .interpolate import clip_and_interpolate_dem
-from .sampling import get_utm_fire_layers, get_sampling_point_grid_layer
+from .sampling import (
+    get_utm_fire_layers,
+    get_building_heights,
+    get_sampling_point_grid_layer,
+    get_sampling_arrays,
+)
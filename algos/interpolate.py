@@ -1,11 +1,30 @@
 import processing
-from qgis.core import QgsProcessing
+from math import ceil
+import numpy as np
+from osgeo import gdal
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingException,
+    QgsProcessingUtils,
+    QgsFeatureRequest,
+    QgsRasterLayer,
+    QgsUnitTypes,
+)
+
+try:
+    from scipy.spatial import Delaunay
+except ImportError:
+    Delaunay = None
+from ..types.utils import get_transformed_xys
 from .utils import (
+    get_pixel_aligned_extent,
     get_pixel_center_aligned_grid_layer,
     set_grid_layer_z,
     get_reprojected_vector_layer,
 )
 
+NODATA = -9999.0  # as qgis:tininterpolation
+
 
 def clip_and_interpolate_dem(
     context,
@@ -14,23 +33,60 @@ def clip_and_interpolate_dem(
     extent,
     extent_crs,
     pixel_size,
+    engine="tin",
+    aggregation=None,
     output=QgsProcessing.TEMPORARY_OUTPUT,
 ):
     text = f"\nInterpolate <{dem_layer}> layer at <{pixel_size}> pixel size..."
     feedback.setProgressText(text)
 
+    # Same crs and integer factor pixel sizes, no interpolation needed
+    resampling = _get_direct_resampling(
+        dem_layer, extent_crs, pixel_size, aggregation=aggregation
+    )
+    if resampling is not None:
+        return _get_direct_dem_layer(
+            context,
+            feedback,
+            dem_layer=dem_layer,
+            extent=extent,
+            extent_crs=extent_crs,
+            pixel_size=pixel_size,
+            resampling=resampling,
+            output=output,
+        )
+
+    # Coarser pixel size, aggregate DEM pixel blocks first
+    if aggregation is not None:
+        tmp = _get_aggregated_dem_layer(
+            context,
+            feedback,
+            dem_layer=dem_layer,
+            extent=extent,
+            extent_crs=extent_crs,
+            pixel_size=pixel_size,
+            resampling=aggregation,
+        )
+
+        if feedback.isCanceled():
+            return {}
+
+        if tmp:
+            dem_layer = QgsRasterLayer(tmp["OUTPUT"], "aggregated_dem")
+
     tmp = get_pixel_center_aligned_grid_layer(
         context,
         feedback,
         raster_layer=dem_layer,
         extent=extent,
         extent_crs=extent_crs,
-        larger=2.0,  # FIXME what if downsampling as in CERN?
+        larger=2.0,
     )
 
     if feedback.isCanceled():
         return {}
 
+    grid_shape = tmp["NROWS"], tmp["NCOLS"]
     tmp = set_grid_layer_z(
         context,
         feedback,
@@ -41,6 +97,21 @@ def clip_and_interpolate_dem(
     if feedback.isCanceled():
         return {}
 
+    if engine == "numpy":
+        if Delaunay:
+            # The grid points are transformed in bulk, not reprojected
+            return _create_raster_from_grid_numpy(
+                context,
+                feedback,
+                grid_layer=tmp["OUTPUT"],
+                grid_shape=grid_shape,
+                extent=extent,
+                extent_crs=extent_crs,
+                pixel_size=pixel_size,
+                output=output,
+            )
+        feedback.reportError("SciPy not available, interpolate with TIN.")
+
     tmp = get_reprojected_vector_layer(
         context,
         feedback,
@@ -61,6 +132,159 @@ def clip_and_interpolate_dem(
     )
 
 
+def _get_direct_resampling(
+    dem_layer, extent_crs, pixel_size, aggregation=None, rtol=1e-6
+):
+    """!
+    Get the gdal resampling method, if the DEM can be read directly.
+    @param dem_layer: DEM QgsRasterLayer.
+    @param extent_crs: destination crs.
+    @param pixel_size: destination pixel size.
+    @param aggregation: gdal resampling method for coarsening, None if not aggregated.
+    @param rtol: relative tolerance on pixel sizes.
+    @return 0 (nearest) for same pixel size, aggregation for integer coarsening,
+    1 (bilinear) for integer refining, None otherwise.
+    """
+    if dem_layer.crs() != extent_crs:
+        return None
+    xres, yres = dem_layer.rasterUnitsPerPixelX(), dem_layer.rasterUnitsPerPixelY()
+    if abs(xres - yres) > rtol * xres:
+        return None
+    ratio = pixel_size / xres
+    factor = round(ratio)
+    if factor >= 1 and abs(ratio - factor) <= rtol * ratio:
+        if factor == 1:
+            return 0
+        if aggregation is not None:
+            return aggregation
+        # No aggregation, the destination pixel centers are sampled, as by
+        # the interpolation path. With odd factors they fall on DEM pixel centers
+        return 0 if factor % 2 else None
+    ratio = xres / pixel_size
+    factor = round(ratio)
+    if factor > 1 and abs(ratio - factor) <= rtol * ratio:
+        return 1
+    return None
+
+
+def _get_direct_dem_layer(
+    context,
+    feedback,
+    dem_layer,
+    extent,
+    extent_crs,
+    pixel_size,
+    resampling,
+    output=QgsProcessing.TEMPORARY_OUTPUT,
+):
+    text = f"Same crs and integer factor pixel size, read the DEM directly..."
+    feedback.pushInfo(text)
+
+    # Align the extent to the DEM pixels,
+    # then enlarge it to whole destination pixels
+    aligned_extent = get_pixel_aligned_extent(
+        context,
+        feedback,
+        raster_layer=dem_layer,
+        extent=extent,
+        extent_crs=extent_crs,
+        larger=0.0,
+        to_centers=False,
+    )
+    ncols = max(ceil(round(aligned_extent.width() / pixel_size, 6)), 1)
+    nrows = max(ceil(round(aligned_extent.height() / pixel_size, 6)), 1)
+    aligned_extent.setXMaximum(aligned_extent.xMinimum() + ncols * pixel_size)
+    aligned_extent.setYMinimum(aligned_extent.yMaximum() - nrows * pixel_size)
+
+    alg_params = {
+        "INPUT": dem_layer,
+        "SOURCE_CRS": None,
+        "TARGET_CRS": extent_crs,
+        "RESAMPLING": resampling,
+        "NODATA": None,
+        "TARGET_RESOLUTION": pixel_size,
+        "OPTIONS": "",
+        "DATA_TYPE": 6,  # Float32, as qgis:tininterpolation
+        "TARGET_EXTENT": aligned_extent,
+        "TARGET_EXTENT_CRS": extent_crs,
+        "MULTITHREADING": False,
+        "EXTRA": "",
+        "OUTPUT": output,
+    }
+    return processing.run(
+        "gdal:warpreproject",
+        alg_params,
+        context=context,
+        feedback=feedback,
+        is_child_algorithm=True,
+    )
+
+
+def _get_aggregated_dem_layer(
+    context,
+    feedback,
+    dem_layer,
+    extent,
+    extent_crs,
+    pixel_size,
+    resampling,
+    output=QgsProcessing.TEMPORARY_OUTPUT,
+):
+    # Blocks of whole DEM pixels, in the DEM crs
+    if dem_layer.crs().mapUnits() != QgsUnitTypes.DistanceMeters:
+        feedback.pushInfo("DEM crs not in meters, no aggregation.")
+        return {}
+    xres, yres = dem_layer.rasterUnitsPerPixelX(), dem_layer.rasterUnitsPerPixelY()
+    factor = int(pixel_size // max(xres, yres))
+    if factor < 2:
+        feedback.pushInfo("DEM pixels not finer than pixel size, no aggregation.")
+        return {}
+    text = f"Aggregate DEM pixels by blocks of {factor}x{factor}..."
+    feedback.pushInfo(text)
+
+    # Align the extent to the DEM pixels, with the margin of the sampling grid,
+    # then enlarge it to whole blocks
+    aligned_extent = get_pixel_aligned_extent(
+        context,
+        feedback,
+        raster_layer=dem_layer,
+        extent=extent,
+        extent_crs=extent_crs,
+        larger=2.0 * factor,
+        to_centers=False,
+    )
+    ncols = max(ceil(round(aligned_extent.width() / (factor * xres), 6)), 1)
+    nrows = max(ceil(round(aligned_extent.height() / (factor * yres), 6)), 1)
+    aligned_extent.setXMaximum(aligned_extent.xMinimum() + ncols * factor * xres)
+    aligned_extent.setYMinimum(aligned_extent.yMaximum() - nrows * factor * yres)
+
+    # Mean and median may fall between DEM values, min and max keep the input type
+    data_type = 6 if resampling in (5, 9) else 0  # Float32 or input
+
+    alg_params = {
+        "INPUT": dem_layer,
+        "SOURCE_CRS": None,
+        "TARGET_CRS": dem_layer.crs(),
+        "RESAMPLING": resampling,
+        "NODATA": None,
+        "TARGET_RESOLUTION": None,
+        "OPTIONS": "",
+        "DATA_TYPE": data_type,
+        "TARGET_EXTENT": aligned_extent,
+        "TARGET_EXTENT_CRS": dem_layer.crs(),
+        "MULTITHREADING": False,
+        "EXTRA": f"-ts {ncols} {nrows}",  # whole blocks, also for rectangular pixels
+        "OUTPUT": output,
+    }
+    return processing.run(
+        "gdal:warpreproject",
+        alg_params,
+        context=context,
+        feedback=feedback,
+        is_child_algorithm=True,
+    )
+
+
 def _create_raster_from_grid(
     context,
     feedback,
@@ -94,3 +318,172 @@ def _create_raster_from_grid(
         feedback=feedback,
         is_child_algorithm=True,
     )
+
+
+def _create_raster_from_grid_numpy(
+    context,
+    feedback,
+    grid_layer,
+    grid_shape,
+    extent,
+    extent_crs,
+    pixel_size,
+    output=QgsProcessing.TEMPORARY_OUTPUT,
+    chunk_len=2**18,
+):
+    # The grid layer may be in another crs
+    text = f"Interpolate elevation in memory..."
+    feedback.pushInfo(text)
+
+    # Read the grid points
+    grid_layer = context.getMapLayer(grid_layer)
+    npoints = grid_layer.featureCount()
+    xys, zs = np.empty((npoints, 2)), np.empty(npoints)
+    request = QgsFeatureRequest().setNoAttributes()
+    n = 0
+    for f in grid_layer.getFeatures(request):
+        g = f.geometry().constGet()  # QgsPoint
+        xys[n] = g.x(), g.y()
+        zs[n] = g.z()
+        n += 1
+    xys, zs = xys[:n], zs[:n]
+    if n < 3:
+        raise QgsProcessingException(
+            f"Only {n} DEM points to interpolate, at least 3 needed, cannot proceed."
+        )
+
+    if grid_layer.crs() == extent_crs and n == grid_shape[0] * grid_shape[1]:
+        # Same crs, the grid is regular
+        interpolate = _get_grid_interpolator(xys, zs, grid_shape)
+    else:
+        # Transform to the extent crs, in one batched call
+        xys[:, 0], xys[:, 1] = get_transformed_xys(
+            xys[:, 0],
+            xys[:, 1],
+            source_crs=grid_layer.crs(),
+            destination_crs=extent_crs,
+            transform_context=context.transformContext(),
+        )
+        interpolate = _get_delaunay_interpolator(xys, zs)
+
+    if feedback.isCanceled():
+        return {}
+
+    # Get the target pixel centers, as QgsGridFileWriter of qgis:tininterpolation
+    nrows = max(ceil(extent.height() / pixel_size) + 1, 1)
+    ncols = max(ceil(extent.width() / pixel_size) + 1, 1)
+    dx, dy = extent.width() / ncols, extent.height() / nrows
+    xs = extent.xMinimum() + dx / 2.0 + np.arange(ncols) * dx
+    ys = extent.yMaximum() - dy / 2.0 - np.arange(nrows) * dy
+
+    # Linear interpolation, by chunks of rows
+    a = np.full((nrows, ncols), np.nan, dtype=np.float32)
+    block_rows = max(chunk_len // ncols, 1)
+    for r0 in range(0, nrows, block_rows):
+        r1 = min(r0 + block_rows, nrows)
+        ps = np.empty((r1 - r0, ncols, 2))
+        ps[:, :, 0], ps[:, :, 1] = xs, ys[r0:r1, np.newaxis]
+        a[r0:r1] = interpolate(ps.reshape(-1, 2)).reshape(r1 - r0, ncols)
+        feedback.setProgress(int(r1 / nrows * 100))
+        if feedback.isCanceled():
+            return {}
+
+    # Save, so that the following algorithms get the raster layer
+    if output == QgsProcessing.TEMPORARY_OUTPUT:
+        output = QgsProcessingUtils.generateTempFilename("interpolated_dem.tif")
+    _write_geotiff(
+        feedback,
+        filepath=output,
+        array=a,
+        geotransform=(extent.xMinimum(), dx, 0.0, extent.yMaximum(), 0.0, -dy),
+        crs=extent_crs,
+    )
+    return {"OUTPUT": output, "ARRAY": a}
+
+
+def _get_delaunay_interpolator(xys, zs):
+    """!
+    Get the linear barycentric interpolator on the Delaunay triangulation of points.
+    @param xys: np.array() of points x, y.
+    @param zs: np.array() of points z.
+    @return function of np.array() of x, y, returning z, NaN outside.
+    """
+    # Triangulate, relative to the first point for precision
+    o = xys[0].copy()
+    tri = Delaunay(xys - o)
+
+    def interpolate(ps):
+        ps = ps - o
+        simplices = tri.find_simplex(ps)
+        is_in = simplices != -1
+        t = tri.transform[simplices[is_in]]
+        bs = np.einsum("nij,nj->ni", t[:, :2], ps[is_in] - t[:, 2])
+        ws = np.column_stack((bs, 1.0 - bs.sum(axis=1)))
+        vs = np.full(len(ps), np.nan)
+        vs[is_in] = (ws * zs[tri.simplices[simplices[is_in]]]).sum(axis=1)
+        return vs
+
+    return interpolate
+
+
+# The points of a regular grid are cocircular four by four,
+# so both diagonals of each square give a Delaunay triangulation.
+# Not to depend on the Delaunay ties, squares are split along
+# the same diagonal of the GEOM terrain faces.
+
+#        j   j  j+1
+#        *-------* i
+#        | f1 // |
+#        |  /·/  |
+#        | // f2 |
+#        *-------* i+1
+
+
+def _get_grid_interpolator(xys, zs, grid_shape):
+    """!
+    Get the linear interpolator on the regular grid of points, split in triangles.
+    @param xys: np.array() of points x, y, by column, as created by native:creategrid.
+    @param zs: np.array() of points z.
+    @param grid_shape: grid nrows, ncols.
+    @return function of np.array() of x, y, returning z, NaN outside.
+    """
+    nrows, ncols = grid_shape
+    if nrows < 2 or ncols < 2:
+        return _get_delaunay_interpolator(xys, zs)
+    gzs = zs.reshape(ncols, nrows).T  # by row
+    x0, y0 = xys[0]  # top left
+    dx, dy = xys[nrows, 0] - x0, xys[1, 1] - y0  # dy negative, rows go downward
+
+    def interpolate(ps):
+        us, vs = (ps[:, 0] - x0) / dx, (ps[:, 1] - y0) / dy
+        is_in = (us >= 0.0) & (us <= ncols - 1) & (vs >= 0.0) & (vs <= nrows - 1)
+        us, vs = us[is_in], vs[is_in]
+        j = np.minimum(np.floor(us).astype(int), ncols - 2)
+        i = np.minimum(np.floor(vs).astype(int), nrows - 2)
+        us, vs = us - j, vs - i
+        z00, z01 = gzs[i, j], gzs[i, j + 1]
+        z10, z11 = gzs[i + 1, j], gzs[i + 1, j + 1]
+        res = np.full(len(ps), np.nan)
+        res[is_in] = np.where(
+            us + vs <= 1.0,
+            z00 + us * (z01 - z00) + vs * (z10 - z00),  # 1st face
+            z11 + (1.0 - us) * (z10 - z11) + (1.0 - vs) * (z01 - z11),  # 2nd face
+        )
+        return res
+
+    return interpolate
+
+
+def _write_geotiff(feedback, filepath, array, geotransform, crs):
+    feedback.pushInfo(f"Save raster: <{filepath}>")
+    nrows, ncols = array.shape
+    ds = gdal.GetDriverByName("GTiff").Create(
+        filepath, ncols, nrows, 1, gdal.GDT_Float32
+    )
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(crs.toWkt())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(np.where(np.isnan(array), NODATA, array))
+    band.FlushCache()
+    ds = None  # close
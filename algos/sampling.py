@@ -1,4 +1,5 @@
 import processing
+import numpy as np
 from qgis.PyQt.QtCore import QVariant
 from qgis.core import (
     QgsProcessing,
@@ -7,6 +8,7 @@ from qgis.core import (
     NULL,
     edit,
     QgsFeatureRequest,
+    QgsRasterLayer,
 )
 from .utils import (
     get_pixel_center_aligned_grid_layer,
@@ -14,6 +16,9 @@ from .utils import (
     set_grid_layer_value,
     get_reprojected_vector_layer,
     get_buffered_vector_layer,
+    get_rasterized_vector_layer,
+    get_raster_block_array,
+    get_aligned_raster_layer,
 )
 
 
@@ -52,6 +57,51 @@ def get_utm_fire_layers(
     return context.getMapLayer(tmp["OUTPUT"]), context.getMapLayer(tmp2["OUTPUT"])
 
 
+def get_building_heights(
+    context,
+    feedback,
+    building_layer,
+    destination_crs,
+    utm_dem_layer,
+):
+    text = f"\nRasterize <{building_layer}> building layer..."
+    feedback.setProgressText(text)
+
+    if building_layer.fields().indexOf("height") == -1:
+        raise QgsProcessingException(
+            f"No <height> field in building layer <{building_layer.name()}>, cannot proceed."
+        )
+
+    tmp = get_reprojected_vector_layer(
+        context,
+        feedback,
+        vector_layer=building_layer,
+        destination_crs=destination_crs,
+    )
+
+    if feedback.isCanceled():
+        return None
+
+    # Burn the heights on the sampling grid cells, in one pass
+    tmp = get_rasterized_vector_layer(
+        context,
+        feedback,
+        vector_layer=tmp["OUTPUT"],
+        field="height",
+        raster_layer=utm_dem_layer,
+    )
+
+    if feedback.isCanceled():
+        return None
+
+    heights = get_raster_block_array(
+        feedback,
+        raster_layer=QgsRasterLayer(tmp["OUTPUT"], "buildings"),
+    )
+    heights[~(heights > 0.0)] = 0.0  # no building, also NaN
+    return heights
+
+
 def get_sampling_point_grid_layer(
     context,
     feedback,
@@ -77,6 +127,8 @@ def get_sampling_point_grid_layer(
     if feedback.isCanceled():
         return {}
 
+    nrows, ncols = tmp["NROWS"], tmp["NCOLS"]
+
     tmp = set_grid_layer_z(
         context,
         feedback,
@@ -137,9 +189,103 @@ def get_sampling_point_grid_layer(
     if feedback.isCanceled():
         return {}
 
+    # Carry the grid shape
+    tmp["NROWS"], tmp["NCOLS"] = nrows, ncols
     return tmp
 
 
+def get_sampling_arrays(
+    context,
+    feedback,
+    utm_dem_layer,
+    landuse_layer,
+    landuse_type,
+    utm_fire_layer,
+    utm_b_fire_layer,
+    dem_array=None,
+):
+    """!
+    Get the sampling matrices by reading raster blocks, with no point layer.
+    The sampling points are the centers of the utm_dem_layer pixels.
+    If dem_array is the interpolated DEM already in memory, it is not read again.
+    @return dict of np.array() 'zs' and 'lus' by row, shape (nrows, ncols),
+    and 'GRID' x0, y0, dx, dy of the top left center.
+    """
+    text = f"\nRead sampling raster blocks for FDS geometry..."
+    feedback.setProgressText(text)
+
+    # Set z, the NODATA as set_grid_layer_z
+    if dem_array is None:
+        zs = get_raster_block_array(feedback, raster_layer=utm_dem_layer)
+    else:
+        zs = dem_array.astype(np.float32)  # a copy
+    zs[np.isnan(zs)] = -999.0
+    nrows, ncols = zs.shape
+    feedback.pushInfo(f"Grid shape: {nrows}x{ncols}")
+
+    if feedback.isCanceled():
+        return {}
+
+    lus = np.zeros((nrows, ncols), dtype=np.uint16)
+    if landuse_layer:
+        # Set landuse, by nearest pixel on the aligned landuse raster
+        tmp = get_aligned_raster_layer(
+            context,
+            feedback,
+            raster_layer=landuse_layer,
+            template_layer=utm_dem_layer,
+        )
+        a = get_raster_block_array(
+            feedback, raster_layer=QgsRasterLayer(tmp["OUTPUT"], "landuse")
+        )
+        if a.shape != zs.shape:
+            raise QgsProcessingException(
+                f"Aligned landuse raster of {a.shape} pixels does not match the DEM of {zs.shape}, cannot proceed."
+            )
+        is_valid = ~np.isnan(a)
+        lus[is_valid] = landuse_type.get_landuses(a[is_valid], report=False)
+
+        if feedback.isCanceled():
+            return {}
+
+        if utm_fire_layer:
+            # Set fire, the burned area overrides the fire front
+            for fire_layer, bc_field, bc_default in (
+                (utm_b_fire_layer, "bc_out", landuse_type.bc_out_default),
+                (utm_fire_layer, "bc_in", landuse_type.bc_in_default),
+            ):
+                feedback.pushInfo(f"Load fire layer bc ({bc_field})...")
+                if fire_layer.fields().indexOf(bc_field) == -1:
+                    bc_field = None  # burn the default
+                tmp = get_rasterized_vector_layer(
+                    context,
+                    feedback,
+                    vector_layer=fire_layer,
+                    field=bc_field,
+                    raster_layer=utm_dem_layer,
+                    burn=bc_default,
+                )
+                bcs = get_raster_block_array(
+                    feedback, raster_layer=QgsRasterLayer(tmp["OUTPUT"], "bc")
+                )
+                is_bc = bcs > 0  # no bc, also NaN
+                lus[is_bc] = landuse_type.get_landuses(bcs[is_bc], report=False)
+
+                if feedback.isCanceled():
+                    return {}
+        else:
+            feedback.pushInfo("No fire layer provided.")
+    else:
+        feedback.pushInfo("No landuse layer provided.")
+
+    # Get the top left center
+    extent = utm_dem_layer.extent()
+    dx = utm_dem_layer.rasterUnitsPerPixelX()
+    dy = utm_dem_layer.rasterUnitsPerPixelY()
+    grid = (extent.xMinimum() + dx / 2.0, extent.yMaximum() - dy / 2.0, dx, -dy)
+    return {"zs": zs, "lus": lus, "GRID": grid}
+
+
 def _load_fire_layer_bc(
     context,
     feedback,
@@ -1,9 +1,13 @@
 import processing
+from math import ceil
+import numpy as np
 from qgis.core import (
+    Qgis,
     QgsProcessing,
     QgsRectangle,
     QgsCoordinateTransform,
     QgsProject,
+    QgsProcessingException,
 )
 
 
@@ -32,16 +36,24 @@ def get_pixel_center_aligned_grid_layer(
     if feedback.isCanceled():
         return {}
 
-    return get_grid_layer(
+    xres = raster_layer.rasterUnitsPerPixelX()
+    yres = raster_layer.rasterUnitsPerPixelY()
+    res = get_grid_layer(
         context,
         feedback,
         extent=aligned_extent,
         extent_crs=raster_layer.crs(),
-        xres=raster_layer.rasterUnitsPerPixelX(),
-        yres=raster_layer.rasterUnitsPerPixelY(),
+        xres=xres,
+        yres=yres,
         output=output,
     )
 
+    # Grid shape, as computed by native:creategrid
+    res["NROWS"] = ceil(aligned_extent.height() / yres)
+    res["NCOLS"] = ceil(aligned_extent.width() / xres)
+    feedback.pushInfo(f"Grid shape: {res['NROWS']}x{res['NCOLS']}")
+    return res
+
 
 def get_pixel_aligned_extent(
     context,
@@ -227,6 +239,41 @@ def get_reprojected_raster_layer(
     )
 
 
+def get_aligned_raster_layer(
+    context,
+    feedback,
+    raster_layer,
+    template_layer,
+    output=QgsProcessing.TEMPORARY_OUTPUT,
+):
+    text = f"Align <{raster_layer}> raster layer to <{template_layer}> pixels..."
+    feedback.pushInfo(text)
+
+    alg_params = {
+        "INPUT": raster_layer,
+        "SOURCE_CRS": None,
+        "TARGET_CRS": template_layer.crs(),
+        "RESAMPLING": 0,  # nearest neighbour, as for sampling
+        "NODATA": None,
+        "TARGET_RESOLUTION": None,
+        "OPTIONS": "",
+        "DATA_TYPE": 0,
+        "TARGET_EXTENT": template_layer.extent(),
+        "TARGET_EXTENT_CRS": template_layer.crs(),
+        "MULTITHREADING": False,
+        # same pixels as the template, also for rectangular pixels
+        "EXTRA": f"-ts {template_layer.width()} {template_layer.height()}",
+        "OUTPUT": output,
+    }
+    return processing.run(
+        "gdal:warpreproject",
+        alg_params,
+        context=context,
+        feedback=feedback,
+        is_child_algorithm=True,
+    )
+
+
 def get_reprojected_vector_layer(
     context,
     feedback,
@@ -308,3 +355,80 @@ def get_extent_layer(
         feedback=feedback,
         is_child_algorithm=True,
     )
+
+
+def get_rasterized_vector_layer(
+    context,
+    feedback,
+    vector_layer,
+    field,
+    raster_layer,
+    burn=0,
+    output=QgsProcessing.TEMPORARY_OUTPUT,
+):
+    # It works when vector and raster share the same crs,
+    # burn is used if there is no field
+    text = f"Rasterize <{vector_layer}> vector layer ({field or burn})..."
+    feedback.pushInfo(text)
+
+    alg_params = {
+        "INPUT": vector_layer,
+        "FIELD": field,
+        "BURN": burn,
+        "USE_Z": False,
+        "UNITS": 1,  # georeferenced units
+        "WIDTH": raster_layer.rasterUnitsPerPixelX(),
+        "HEIGHT": raster_layer.rasterUnitsPerPixelY(),
+        "EXTENT": raster_layer.extent(),  # aligned to raster_layer pixels
+        "NODATA": 0,
+        "OPTIONS": "",
+        "DATA_TYPE": 5,  # Float32
+        "INIT": 0,
+        "INVERT": False,
+        "EXTRA": "",
+        "OUTPUT": output,
+    }
+    return processing.run(
+        "gdal:rasterize",
+        alg_params,
+        context=context,
+        feedback=feedback,
+        is_child_algorithm=True,
+    )
+
+
+_RASTER_DTYPES = {
+    Qgis.Byte: np.uint8,
+    Qgis.UInt16: np.uint16,
+    Qgis.Int16: np.int16,
+    Qgis.UInt32: np.uint32,
+    Qgis.Int32: np.int32,
+    Qgis.Float32: np.float32,
+    Qgis.Float64: np.float64,
+}
+
+
+def get_raster_block_array(feedback, raster_layer, band=1):
+    """!
+    Read a raster layer band in one block, as a matrix of its pixels.
+    @param feedback: feedback.
+    @param raster_layer: QgsRasterLayer.
+    @param band: band number.
+    @return np.array() of pixel values, shape (nrows, ncols), nodata pixels are NaN.
+    """
+    text = f"Read <{raster_layer.name()}> raster layer..."
+    feedback.pushInfo(text)
+
+    provider = raster_layer.dataProvider()
+    nrows, ncols = raster_layer.height(), raster_layer.width()
+    block = provider.block(band, raster_layer.extent(), ncols, nrows)
+    dtype = _RASTER_DTYPES.get(block.dataType())
+    if dtype is None:
+        raise QgsProcessingException(
+            f"Raster layer <{raster_layer.name()}> data type not supported, cannot proceed."
+        )
+    a = np.frombuffer(bytes(block.data()), dtype=dtype).reshape(nrows, ncols)
+    a = a.astype(np.float32)  # a copy, as the buffer is read only
+    if block.hasNoDataValue():
+        a[a == block.noDataValue()] = np.nan
+    return a
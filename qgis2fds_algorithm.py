@@ -11,6 +11,7 @@ DEBUG = False
 
 from qgis.core import (
     QgsProject,
+    QgsProcessing,
     QgsPoint,
     QgsCoordinateReferenceSystem,
     QgsCoordinateTransform,
@@ -26,6 +27,7 @@ from qgis.core import (
     QgsProcessingParameterDefinition,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterBoolean,
+    QgsProcessingParameterEnum,
     QgsRasterFileWriter,
     QgsRasterLayer,
     QgsRasterPipe,
@@ -39,9 +41,13 @@ from .types import (
     Domain,
     OBSTTerrain,
     GEOMTerrain,
+    ZVALSTerrain,
     LanduseType,
     Texture,
     Wind,
+    Buildings,
+    Vegetation,
+    Devices,
 )
 from . import algos
 import processing
@@ -56,15 +62,38 @@ DEFAULTS = {
     "landuse_layer": None,
     "landuse_type_filepath": "",
     "fire_layer": None,
+    "building_layer": None,
+    "vegetation_layer": None,
+    "devc_layer": None,
     "wind_filepath": "",
     "tex_layer": None,
     "tex_pixel_size": 5.0,
     "nmesh": 1,
     "cell_size": None,
     "export_obst": True,
+    "export_zvals": False,
+    "merge_obsts": False,
+    "snap_obsts": 0,
+    "geom_tolerance": None,
+    "split_terrain": False,
+    "text_nprocs": 1,
+    "memory_budget": None,
+    "lod_distance": None,
+    "raster_sampling": False,
+    "dem_interpolation": 0,
+    "dem_aggregation": 0,
     "debug": False,
 }
 
+SNAP_OBSTS_OPTIONS = ("No", "Yes, mean height", "Yes, max height")
+SNAP_OBSTS_MODES = (None, "mean", "max")
+
+DEM_INTERPOLATION_OPTIONS = ("QGIS TIN", "NumPy Delaunay (needs SciPy)")
+DEM_INTERPOLATION_MODES = ("tin", "numpy")
+
+DEM_AGGREGATION_OPTIONS = ("No", "Mean", "Min", "Max", "Median")
+DEM_AGGREGATION_MODES = (None, 5, 8, 7, 9)  # gdal:warpreproject resampling
+
 
 class qgis2fdsAlgorithm(QgsProcessingAlgorithm):
     """
@@ -229,26 +258,59 @@ class qgis2fdsAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
-        # Define parameters: devc_layer  # FIXME implement
-        #
-        # defaultValue, _ = project.readEntry("qgis2fds", "devc_layer", None)
-        # if not defaultValue:
-        #     try:  # first layer name containing "devc"
-        #         defaultValue = [
-        #             layer.name()
-        #             for layer in QgsProject.instance().mapLayers().values()
-        #             if "DEVC" in layer.name() or "devc" in layer.name()
-        #         ][0]
-        #     except IndexError:
-        #         pass
-        # self.addParameter(
-        #     QgsProcessingParameterVectorLayer(
-        #         "devc_layer",
-        #         "FDS DEVCs layer",
-        #         optional=True,
-        #         defaultValue=defaultValue,
-        #     )
-        # )
+        # Define parameters: building_layer [optional]
+
+        defaultValue, _ = project.readEntry(
+            "qgis2fds", "building_layer", DEFAULTS["building_layer"]
+        )
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                "building_layer",
+                "Building footprint layer (with height field)",
+                types=[QgsProcessing.TypeVectorPolygon],
+                optional=True,
+                defaultValue=defaultValue,
+            )
+        )
+
+        # Define parameters: vegetation_layer [optional]
+
+        defaultValue, _ = project.readEntry(
+            "qgis2fds", "vegetation_layer", DEFAULTS["vegetation_layer"]
+        )
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                "vegetation_layer",
+                "Vegetation point layer (with part_id, height, crown_base fields)",
+                types=[QgsProcessing.TypeVectorPoint],
+                optional=True,
+                defaultValue=defaultValue,
+            )
+        )
+
+        # Define parameters: devc_layer [optional]
+
+        defaultValue, _ = project.readEntry(
+            "qgis2fds", "devc_layer", DEFAULTS["devc_layer"]
+        )
+        if not defaultValue:
+            try:  # first layer name containing "devc"
+                defaultValue = [
+                    layer.name()
+                    for layer in QgsProject.instance().mapLayers().values()
+                    if "DEVC" in layer.name() or "devc" in layer.name()
+                ][0]
+            except IndexError:
+                pass
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                "devc_layer",
+                "FDS DEVCs layer (with id, quantity, agl fields)",
+                types=[QgsProcessing.TypeVectorPoint],
+                optional=True,
+                defaultValue=defaultValue,
+            )
+        )
 
         # Define parameters: wind_filepath [optional]
 
@@ -335,6 +397,157 @@ class qgis2fdsAlgorithm(QgsProcessingAlgorithm):
         self.addParameter(param)
         param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
 
+        # Define parameter: export_zvals
+
+        defaultValue, _ = project.readBoolEntry(
+            "qgis2fds", "export_zvals", DEFAULTS["export_zvals"]
+        )
+        param = QgsProcessingParameterBoolean(
+            "export_zvals",
+            "Export FDS GEOM terrain as ZVALS (if not exporting OBSTs; a single SURF_ID, the most frequent, also replaces the fire layer bc; terrain split, GEOM tolerance, and full resolution distance are ignored)",
+            defaultValue=defaultValue,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
+        # Define parameter: merge_obsts
+
+        defaultValue, _ = project.readBoolEntry(
+            "qgis2fds", "merge_obsts", DEFAULTS["merge_obsts"]
+        )
+        param = QgsProcessingParameterBoolean(
+            "merge_obsts",
+            "Merge adjacent FDS OBSTs of same height and landuse",
+            defaultValue=defaultValue,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
+        # Define parameter: snap_obsts
+
+        defaultValue, _ = project.readNumEntry(
+            "qgis2fds", "snap_obsts", DEFAULTS["snap_obsts"]
+        )
+        param = QgsProcessingParameterEnum(
+            "snap_obsts",
+            "Aggregate FDS OBSTs on MESH cells, if coarser than desired resolution",
+            options=SNAP_OBSTS_OPTIONS,
+            defaultValue=defaultValue,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
+        # Define parameter: geom_tolerance
+
+        defaultValue, _ = project.readDoubleEntry("qgis2fds", "geom_tolerance")
+        param = QgsProcessingParameterNumber(
+            "geom_tolerance",
+            "FDS GEOM simplification vertical tolerance (in meters; if not set, no simplification)",
+            type=QgsProcessingParameterNumber.Double,
+            optional=True,
+            defaultValue=defaultValue or None,  # protect
+            minValue=0.0,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
+        # Define parameter: split_terrain
+
+        defaultValue, _ = project.readBoolEntry(
+            "qgis2fds", "split_terrain", DEFAULTS["split_terrain"]
+        )
+        param = QgsProcessingParameterBoolean(
+            "split_terrain",
+            "Split the terrain output by FDS MESH (GEOM: a bingeom file for each MESH; OBST: only grouped by MESH, all MPI processes still read them)",
+            defaultValue=defaultValue,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
+        # Define parameter: text_nprocs
+
+        defaultValue, _ = project.readNumEntry(
+            "qgis2fds", "text_nprocs", DEFAULTS["text_nprocs"]
+        )
+        param = QgsProcessingParameterNumber(
+            "text_nprocs",
+            "Number of processes formatting the OBST and ZVALS terrain text",
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=defaultValue,
+            minValue=1,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
+        # Define parameter: memory_budget
+
+        defaultValue, _ = project.readNumEntry("qgis2fds", "memory_budget")
+        param = QgsProcessingParameterNumber(
+            "memory_budget",
+            "Terrain memory budget (in MB; if not set, no limit)",
+            type=QgsProcessingParameterNumber.Integer,
+            optional=True,
+            defaultValue=defaultValue or None,  # protect
+            minValue=1,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
+        # Define parameter: lod_distance
+
+        defaultValue, _ = project.readDoubleEntry("qgis2fds", "lod_distance")
+        param = QgsProcessingParameterNumber(
+            "lod_distance",
+            "Terrain full resolution distance from the fire layer (in meters; if not set, full resolution everywhere)",
+            type=QgsProcessingParameterNumber.Double,
+            optional=True,
+            defaultValue=defaultValue or None,  # protect
+            minValue=0.0,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
+        # Define parameter: raster_sampling
+
+        defaultValue, _ = project.readBoolEntry(
+            "qgis2fds", "raster_sampling", DEFAULTS["raster_sampling"]
+        )
+        param = QgsProcessingParameterBoolean(
+            "raster_sampling",
+            "Sample the terrain by raster blocks, without the sampling point layer",
+            defaultValue=defaultValue,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
+        # Define parameter: dem_interpolation
+
+        defaultValue, _ = project.readNumEntry(
+            "qgis2fds", "dem_interpolation", DEFAULTS["dem_interpolation"]
+        )
+        param = QgsProcessingParameterEnum(
+            "dem_interpolation",
+            "DEM interpolation engine",
+            options=DEM_INTERPOLATION_OPTIONS,
+            defaultValue=defaultValue,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
+        # Define parameter: dem_aggregation
+
+        defaultValue, _ = project.readNumEntry(
+            "qgis2fds", "dem_aggregation", DEFAULTS["dem_aggregation"]
+        )
+        param = QgsProcessingParameterEnum(
+            "dem_aggregation",
+            "Aggregate DEM pixels by blocks, if finer than desired resolution",
+            options=DEM_AGGREGATION_OPTIONS,
+            defaultValue=defaultValue,
+        )
+        self.addParameter(param)
+        param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+
         # Define parameter: debug
         defaultValue, _ = project.readBoolEntry(
             "qgis2fds", "debug", DEFAULTS["debug"]
@@ -531,15 +744,48 @@ class qgis2fdsAlgorithm(QgsProcessingAlgorithm):
                 "qgis2fds", "fire_layer", parameters.get("fire_layer")
             )  # as str
 
-        # Get devc_layer (optional)
-        # devc_layer = None
-        # if parameters["devc_layer"]:
-        #     devc_layer = self.parameterAsVectorLayer(parameters, "devc_layer", context)
-        #     if not devc_layer.crs().isValid():
-        #         raise QgsProcessingException(
-        #             f"DEVCs layer CRS <{devc_layer.crs().description()}> is not valid, cannot proceed."
-        #         )
-        # project.writeEntry("qgis2fds", "devc_layer", parameters["devc_layer"])
+        # Get parameter: building_layer (optional)
+
+        building_layer = None
+        if "building_layer" in parameters:
+            building_layer = self.parameterAsVectorLayer(
+                parameters, "building_layer", context
+            )
+            if building_layer and not building_layer.crs().isValid():
+                raise QgsProcessingException(
+                    f"Building layer CRS <{building_layer.crs().description()}> is not valid, cannot proceed."
+                )
+            project.writeEntry(
+                "qgis2fds", "building_layer", parameters.get("building_layer")
+            )  # as str
+
+        # Get parameter: vegetation_layer (optional)
+
+        vegetation_layer = None
+        if "vegetation_layer" in parameters:
+            vegetation_layer = self.parameterAsVectorLayer(
+                parameters, "vegetation_layer", context
+            )
+            if vegetation_layer and not vegetation_layer.crs().isValid():
+                raise QgsProcessingException(
+                    f"Vegetation layer CRS <{vegetation_layer.crs().description()}> is not valid, cannot proceed."
+                )
+            project.writeEntry(
+                "qgis2fds", "vegetation_layer", parameters.get("vegetation_layer")
+            )  # as str
+
+        # Get parameter: devc_layer (optional)
+
+        devc_layer = None
+        if "devc_layer" in parameters:
+            devc_layer = self.parameterAsVectorLayer(parameters, "devc_layer", context)
+            if devc_layer and not devc_layer.crs().isValid():
+                raise QgsProcessingException(
+                    f"DEVCs layer CRS <{devc_layer.crs().description()}> is not valid, cannot proceed."
+                )
+            project.writeEntry(
+                "qgis2fds", "devc_layer", parameters.get("devc_layer")
+            )  # as str
 
         # Get parameter: wind_filepath (optional)
 
@@ -583,19 +829,87 @@ class qgis2fdsAlgorithm(QgsProcessingAlgorithm):
             utm_crs=utm_crs,
         )
 
-        # Get DEVCs layer  # FIXME implement
-        # utm_devc_layer = None
-        # if devc_layer:
-        #     pass
-
-        #     if feedback.isCanceled():
-        #         return {}
-
         # Get parameter: export_obst
 
         export_obst = self.parameterAsBool(parameters, "export_obst", context)
         project.writeEntryBool("qgis2fds", "export_obst", export_obst)
 
+        # Get parameter: export_zvals
+
+        export_zvals = self.parameterAsBool(parameters, "export_zvals", context)
+        project.writeEntryBool("qgis2fds", "export_zvals", export_zvals)
+
+        # Get parameter: merge_obsts
+
+        merge_obsts = self.parameterAsBool(parameters, "merge_obsts", context)
+        project.writeEntryBool("qgis2fds", "merge_obsts", merge_obsts)
+
+        # Get parameter: snap_obsts
+
+        snap_obsts = self.parameterAsEnum(parameters, "snap_obsts", context)
+        project.writeEntry("qgis2fds", "snap_obsts", snap_obsts)
+        snap_obsts = SNAP_OBSTS_MODES[snap_obsts]
+
+        # Get parameter: geom_tolerance
+
+        geom_tolerance = self.parameterAsDouble(parameters, "geom_tolerance", context)
+        if not geom_tolerance:
+            geom_tolerance = None
+            project.writeEntry("qgis2fds", "geom_tolerance", "")
+        else:
+            project.writeEntryDouble("qgis2fds", "geom_tolerance", geom_tolerance)
+
+        # Get parameter: split_terrain
+
+        split_terrain = self.parameterAsBool(parameters, "split_terrain", context)
+        project.writeEntryBool("qgis2fds", "split_terrain", split_terrain)
+
+        # Get parameter: text_nprocs
+
+        text_nprocs = self.parameterAsInt(parameters, "text_nprocs", context)
+        if not text_nprocs or text_nprocs < 1:
+            raise QgsProcessingException(
+                self.invalidSourceError(parameters, "text_nprocs")
+            )
+        project.writeEntry("qgis2fds", "text_nprocs", text_nprocs)
+
+        # Get parameter: memory_budget
+
+        memory_budget = self.parameterAsInt(parameters, "memory_budget", context)
+        if not memory_budget:
+            memory_budget = None
+            project.writeEntry("qgis2fds", "memory_budget", "")
+        else:
+            project.writeEntry("qgis2fds", "memory_budget", memory_budget)
+
+        # Get parameter: lod_distance
+
+        lod_distance = self.parameterAsDouble(parameters, "lod_distance", context)
+        if not lod_distance:
+            lod_distance = None
+            project.writeEntry("qgis2fds", "lod_distance", "")
+        else:
+            project.writeEntryDouble("qgis2fds", "lod_distance", lod_distance)
+
+        # Get parameter: raster_sampling
+
+        raster_sampling = self.parameterAsBool(parameters, "raster_sampling", context)
+        project.writeEntryBool("qgis2fds", "raster_sampling", raster_sampling)
+
+        # Get parameter: dem_interpolation
+
+        dem_interpolation = self.parameterAsEnum(
+            parameters, "dem_interpolation", context
+        )
+        project.writeEntry("qgis2fds", "dem_interpolation", dem_interpolation)
+        dem_interpolation = DEM_INTERPOLATION_MODES[dem_interpolation]
+
+        # Get parameter: dem_aggregation
+
+        dem_aggregation = self.parameterAsEnum(parameters, "dem_aggregation", context)
+        project.writeEntry("qgis2fds", "dem_aggregation", dem_aggregation)
+        dem_aggregation = DEM_AGGREGATION_MODES[dem_aggregation]
+
         # Get parameter: dem_layer
 
         dem_layer = self.parameterAsRasterLayer(parameters, "dem_layer", context)
@@ -618,6 +932,8 @@ class qgis2fdsAlgorithm(QgsProcessingAlgorithm):
             extent=utm_extent,
             extent_crs=utm_crs,
             pixel_size=pixel_size,
+            engine=dem_interpolation,
+            aggregation=dem_aggregation,
             # output=parameters["utm_dem_layer"],  # DEBUG
         )
 
@@ -627,30 +943,68 @@ class qgis2fdsAlgorithm(QgsProcessingAlgorithm):
         # results["utm_dem_layer"] = outputs["utm_dem_layer"]["OUTPUT"] # DEBUG
         utm_dem_layer = QgsRasterLayer(outputs["utm_dem_layer"]["OUTPUT"])
 
-        # Get the sampling grid
-        outputs["sampling_layer"] = algos.get_sampling_point_grid_layer(
-            context,
-            feedback,
-            utm_dem_layer=utm_dem_layer,
-            landuse_layer=landuse_layer,
-            landuse_type=landuse_type,
-            utm_fire_layer=utm_fire_layer,  # utm
-            utm_b_fire_layer=utm_b_fire_layer,  # utm buffered
-            # output=parameters["sampling_layer"],  # DEBUG
-        )
+        # Get the building heights on the sampling grid cells
 
-        if feedback.isCanceled():
-            return {}
+        building_heights = None
+        if building_layer:
+            building_heights = algos.get_building_heights(
+                context,
+                feedback,
+                building_layer=building_layer,
+                destination_crs=utm_crs,
+                utm_dem_layer=utm_dem_layer,
+            )
 
-        # if DEBUG:
-        #     results["sampling_layer"] = outputs["sampling_layer"]["OUTPUT"]  # DEBUG FIXME
-        sampling_layer = context.getMapLayer(outputs["sampling_layer"]["OUTPUT"])
+            if feedback.isCanceled():
+                return {}
+
+        # Get the sampling grid, or the sampling raster blocks
+
+        sampling_layer, sampling_arrays = None, None
+        if raster_sampling:
+            sampling_arrays = algos.get_sampling_arrays(
+                context,
+                feedback,
+                utm_dem_layer=utm_dem_layer,
+                landuse_layer=landuse_layer,
+                landuse_type=landuse_type,
+                utm_fire_layer=utm_fire_layer,  # utm
+                utm_b_fire_layer=utm_b_fire_layer,  # utm buffered
+                dem_array=outputs["utm_dem_layer"].get("ARRAY"),  # if in memory
+            )
 
-        if sampling_layer.featureCount() < 9:
-            raise QgsProcessingException(
-                f"[QGIS bug] Too few features in sampling layer, cannot proceed.\n{sampling_layer.featureCount()}"
+            if feedback.isCanceled():
+                return {}
+
+            sampling_shape = sampling_arrays["zs"].shape
+        else:
+            outputs["sampling_layer"] = algos.get_sampling_point_grid_layer(
+                context,
+                feedback,
+                utm_dem_layer=utm_dem_layer,
+                landuse_layer=landuse_layer,
+                landuse_type=landuse_type,
+                utm_fire_layer=utm_fire_layer,  # utm
+                utm_b_fire_layer=utm_b_fire_layer,  # utm buffered
+                # output=parameters["sampling_layer"],  # DEBUG
             )
 
+            if feedback.isCanceled():
+                return {}
+
+            # if DEBUG:
+            #     results["sampling_layer"] = outputs["sampling_layer"]["OUTPUT"]  # DEBUG FIXME
+            sampling_layer = context.getMapLayer(outputs["sampling_layer"]["OUTPUT"])
+            sampling_shape = (
+                outputs["sampling_layer"]["NROWS"],
+                outputs["sampling_layer"]["NCOLS"],
+            )
+
+            if sampling_layer.featureCount() < 9:
+                raise QgsProcessingException(
+                    f"[QGIS bug] Too few features in sampling layer, cannot proceed.\n{sampling_layer.featureCount()}"
+                )
+
         # Align utm_extent to the new interpolated dem
         utm_extent = algos.get_pixel_aligned_extent(
             context,
@@ -697,22 +1051,53 @@ class qgis2fdsAlgorithm(QgsProcessingAlgorithm):
         # Prepare terrain, domain, and fds_case
         if export_obst:
             Terrain = OBSTTerrain
+        elif export_zvals:
+            Terrain = ZVALSTerrain
         else:
             Terrain = GEOMTerrain
         terrain = Terrain(
             feedback=feedback,
             sampling_layer=sampling_layer,
+            sampling_shape=sampling_shape,
             utm_origin=utm_origin,
             landuse_layer=landuse_layer,
             landuse_type=landuse_type,
             fire_layer=fire_layer,
             path=fds_path,
             name=chid,
+            cell_size=cell_size,
+            merge_obsts=merge_obsts,
+            snap_obsts=snap_obsts,
+            geom_tolerance=geom_tolerance,
+            split_terrain=split_terrain,
+            text_nprocs=text_nprocs,
+            memory_budget=memory_budget,
+            lod_distance=lod_distance,
+            utm_fire_layer=utm_fire_layer,
+            sampling_arrays=sampling_arrays,
         )
 
         if feedback.isCanceled():
+            terrain.close()
             return {}
 
+        buildings = Buildings(
+            feedback=feedback,
+            building_layer=building_layer,
+            heights=building_heights,
+            terrain=terrain,
+            cell_size=cell_size,
+        )
+
+        vegetation = Vegetation(
+            feedback=feedback,
+            vegetation_layer=vegetation_layer,
+            utm_crs=utm_crs,  # transformed in bulk
+            terrain=terrain,
+            cell_size=cell_size,
+            transform_context=context.transformContext(),
+        )
+
         domain = Domain(
             feedback=feedback,
             utm_crs=utm_crs,
@@ -720,11 +1105,29 @@ class qgis2fdsAlgorithm(QgsProcessingAlgorithm):
             utm_origin=utm_origin,
             wgs84_origin=wgs84_origin,
             min_z=terrain.min_z,
-            max_z=terrain.max_z,
+            max_z=max(buildings.max_z, vegetation.max_z),  # over all tops
             cell_size=cell_size,
             nmesh=nmesh,
         )
 
+        terrain.set_domain(domain)
+
+        if feedback.isCanceled():
+            terrain.close()
+            return {}
+
+        devices = Devices(
+            feedback=feedback,
+            devc_layer=devc_layer,
+            utm_crs=utm_crs,  # transformed in bulk
+            terrain=terrain,
+            transform_context=context.transformContext(),
+        )
+
+        if feedback.isCanceled():
+            terrain.close()
+            return {}
+
         fds_case = FDSCase(
             feedback=feedback,
             path=fds_path,
@@ -737,6 +1140,9 @@ class qgis2fdsAlgorithm(QgsProcessingAlgorithm):
             terrain=terrain,
             texture=texture,
             wind=wind,
+            buildings=buildings,
+            vegetation=vegetation,
+            devices=devices,
         )
         fds_case.save()
 
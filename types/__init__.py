@@ -7,9 +7,12 @@ __date__ = "2020-05-04"
 __copyright__ = "(C) 2020 by Emanuele Gissi"
 __revision__ = "$Format:%H$"  # replaced with git SHA1
 
+from .buildings import Buildings
+from .devices import Devices
 from .domain import Domain
 from .fds import FDSCase
 from .landuse import LanduseType
-from .terrain import GEOMTerrain, OBSTTerrain
+from .terrain import GEOMTerrain, OBSTTerrain, ZVALSTerrain
 from .texture import Texture
+from .vegetation import Vegetation
 from .wind import Wind
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""qgis2fds"""
+
+__author__ = "Emanuele Gissi"
+__date__ = "2020-05-04"
+__copyright__ = "(C) 2020 by Emanuele Gissi"
+__revision__ = "$Format:%H$"  # replaced with git SHA1
+
+import numpy as np
+from qgis.core import QgsProcessingException
+from .terrain import get_merged_rects, get_rect_xbs, get_rect_lines
+
+
+# The building footprints are rasterized on the terrain matrix,
+# each building cell sits on the local terrain z of its center.
+# Bottoms and tops are quantized to the FDS cell size,
+# then adjacent cells with same bottom and top are merged into OBSTs.
+
+
+class Buildings:
+    def __init__(
+        self, feedback, building_layer, heights, terrain, cell_size
+    ) -> None:
+        self.feedback = feedback
+        self.building_layer = building_layer
+        self.cell_size = cell_size
+        self._xbs = np.empty((0, 6))
+        self.max_z = terrain.max_z  # of terrain and building tops
+
+        # Check
+        if heights is None:
+            feedback.pushInfo("No building layer provided.")
+            return
+        if heights.shape != terrain.sampling_shape:
+            raise QgsProcessingException(
+                f"Building raster of {heights.shape} cells does not match the terrain matrix of {terrain.sampling_shape}, cannot proceed."
+            )
+        feedback.pushInfo("Prepare building OBSTs...")
+
+        # Quantize building cells bottoms and tops to the FDS cell size,
+        # empty cells have key 0
+        zs, grid = terrain.get_matrix()
+        min_z = terrain.min_z
+        is_building = heights > 0.0
+        bottoms = np.floor((zs - min_z) / cell_size).astype(np.int64)
+        tops = np.rint((zs + heights - min_z) / cell_size).astype(np.int64)
+        tops = np.maximum(tops, bottoms + 1)  # at least one cell
+        keys = np.where(is_building, bottoms * (tops.max() + 1) + tops + 1, 0)
+
+        # Get the rectangles of equal building cells
+        i0, i1, j0, j1 = get_merged_rects(keys=keys)
+        is_used = keys[i0, j0] > 0
+        i0, i1, j0, j1 = i0[is_used], i1[is_used], j0[is_used], j1[is_used]
+
+        # Build the XBs
+        self._xbs = xbs = get_rect_xbs(
+            grid=grid,
+            i0=i0,
+            i1=i1,
+            j0=j0,
+            j1=j1,
+            bottoms=min_z + bottoms[i0, j0] * cell_size,
+            tops=min_z + tops[i0, j0] * cell_size,
+        )
+        self.max_z = float(xbs[:, 5].max(initial=terrain.max_z))
+        feedback.pushInfo(
+            f"{np.count_nonzero(is_building)} building cells merged into {len(xbs)} OBSTs."
+        )
+
+    def get_comment(self) -> str:
+        return f"Building layer: {self.building_layer and self.building_layer.name() or 'none'}"
+
+    def iter_fds(self):
+        """Get the FDS text, by chunks."""
+        if not len(self._xbs):
+            return
+        xbs = self._xbs
+        yield f"""
+Buildings ({len(xbs)} OBSTs)
+"""
+        yield from get_rect_lines(
+            feedback=self.feedback,
+            fmt="&OBST XB=%.2f,%.2f,%.2f,%.2f,%.2f,%.2f SURF_ID='INERT' /\n",
+            xbs=xbs,
+        )
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""qgis2fds"""
+
+__author__ = "Emanuele Gissi"
+__date__ = "2020-05-04"
+__copyright__ = "(C) 2020 by Emanuele Gissi"
+__revision__ = "$Format:%H$"  # replaced with git SHA1
+
+import numpy as np
+from . import utils
+
+
+# The DEVC points are placed at their height above ground level,
+# on the terrain z bilinearly interpolated between the quad faces centers.
+
+
+def get_bilinear_values(a, grid, xs, ys):
+    """!
+    Interpolate a matrix on a regular grid, at many points at once.
+    Points outside the grid get the values of its border.
+    @param a: np.array() of values, shape (nrows, ncols).
+    @param grid: x0, y0, dx, dy of the grid.
+    @param xs: np.array() of point x.
+    @param ys: np.array() of point y.
+    @return np.array() of interpolated values.
+    """
+    x0, y0, dx, dy = grid
+    nrows, ncols = a.shape
+    fis = np.clip((ys - y0) / dy, 0.0, nrows - 1)
+    fjs = np.clip((xs - x0) / dx, 0.0, ncols - 1)
+    is_ = np.minimum(fis.astype(np.int64), nrows - 2)  # top left corners
+    js = np.minimum(fjs.astype(np.int64), ncols - 2)
+    u, v = fjs - js, fis - is_  # along cols, along rows
+    return (
+        (1.0 - v) * ((1.0 - u) * a[is_, js] + u * a[is_, js + 1])
+        + v * ((1.0 - u) * a[is_ + 1, js] + u * a[is_ + 1, js + 1])
+    )
+
+
+def get_fds_ids(ids, prefix):
+    """!
+    Get valid and unique FDS IDs.
+    Quotes are removed, empty IDs are named by prefix and position,
+    and duplicates get a numeric suffix.
+    @param ids: np.array() of IDs, None if missing.
+    @param prefix: prefix of the missing IDs.
+    @return np.array() of str IDs.
+    """
+    fds_ids = np.empty(len(ids), dtype=object)
+    for n, i in enumerate(ids):
+        i = i is not None and str(i).replace("'", "").replace('"', "").strip()
+        fds_ids[n] = i or f"{prefix}{n}"
+    used = set(fds_ids)
+    suffixes = dict()  # next suffix of each ID
+    for n, i in enumerate(fds_ids):
+        if i not in suffixes:
+            suffixes[i] = 1  # first, kept
+            continue
+        while f"{i}_{suffixes[i]}" in used:
+            suffixes[i] += 1
+        fds_ids[n] = f"{i}_{suffixes[i]}"
+        used.add(fds_ids[n])
+    return fds_ids
+
+
+class Devices:
+    def __init__(
+        self, feedback, devc_layer, utm_crs, terrain, transform_context=None
+    ) -> None:
+        self.feedback = feedback
+        self.devc_layer = devc_layer
+        self._ids = self._quantities = np.empty(0, dtype=object)
+        self._xyzs = np.empty((0, 3))
+
+        # Check
+        if not devc_layer:
+            feedback.pushInfo("No FDS DEVCs layer provided.")
+            return
+        feedback.pushInfo("Prepare DEVCs...")
+
+        # Read the devices, transformed to utm in bulk
+        xs, ys, (ids, quantities, agls) = utils.get_point_layer_arrays(
+            feedback=feedback,
+            layer=devc_layer,
+            utm_origin=terrain.utm_origin,
+            field_names=("id", "quantity", "agl"),
+            utm_crs=utm_crs,
+            transform_context=transform_context,
+        )
+        self._ids = get_fds_ids(ids, prefix="DEVC")
+        nchanged = sum(
+            i is not None and str(i) != fds_id for i, fds_id in zip(ids, self._ids)
+        )
+        if nchanged:
+            feedback.reportError(
+                f"{nchanged} DEVC IDs with quotes, empty, or duplicated, renamed."
+            )
+        self._quantities = utils.get_fds_texts(quantities, default="TEMPERATURE")
+        nchanged = sum(
+            q is not None and str(q) != fds_q
+            for q, fds_q in zip(quantities, self._quantities)
+        )
+        if nchanged:
+            feedback.reportError(
+                f"{nchanged} DEVC QUANTITYs with quotes or empty, renamed."
+            )
+        agls[np.equal(agls, None)] = 2.0
+
+        # Place on the terrain, in bulk
+        zs, grid = terrain.get_matrix()
+        nrows, ncols = zs.shape
+        x0, y0, dx, dy = grid
+        is_out = (
+            ((xs - x0) / dx < -0.5)
+            | ((xs - x0) / dx > ncols - 0.5)
+            | ((ys - y0) / dy < -0.5)
+            | ((ys - y0) / dy > nrows - 0.5)
+        )
+        if is_out.any():
+            feedback.reportError(
+                f"{np.count_nonzero(is_out)} DEVCs outside the terrain, placed on its border height."
+            )
+        xyzs = np.empty((len(xs), 3))
+        xyzs[:, 0], xyzs[:, 1] = xs, ys
+        xyzs[:, 2] = get_bilinear_values(zs, grid, xs, ys) + agls.astype(np.float64)
+        self._xyzs = xyzs
+        feedback.pushInfo(f"{len(xyzs)} DEVCs placed above ground level.")
+
+    def get_comment(self) -> str:
+        return f"FDS DEVCs layer: {self.devc_layer and self.devc_layer.name() or 'none'}"
+
+    def iter_fds(self):
+        """Get the FDS text, by chunks."""
+        if not len(self._xyzs):
+            return
+        xyzs = self._xyzs
+        yield f"""
+DEVCs ({len(xyzs)})
+"""
+        yield from utils.get_formatted_lines(
+            feedback=self.feedback,
+            fmt="&DEVC ID='%s' XYZ=%.2f,%.2f,%.2f QUANTITY='%s' /\n",
+            columns=(self._ids, xyzs[:, 0], xyzs[:, 1], xyzs[:, 2], self._quantities),
+        )
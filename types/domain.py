@@ -8,6 +8,7 @@ __copyright__ = "(C) 2020 by Emanuele Gissi"
 __revision__ = "$Format:%H$"  # replaced with git SHA1
 
 from math import sqrt
+import numpy as np
 from . import utils
 
 
@@ -67,6 +68,11 @@ class Domain:
         # Calc MESH MULT DX DY
         mult_dx, mult_dy = m_xb[1] - m_xb[0], m_xb[3] - m_xb[2]
 
+        # Keep MESH layout
+        self.nmesh_x, self.nmesh_y = nmesh_x, nmesh_y
+        self.mesh_xb, self.mesh_ijk = m_xb, m_ijk
+        self.mult_dx, self.mult_dy = mult_dx, mult_dy
+
         # Calc MESH size and cell number
         mesh_sizes = [m_xb[1] - m_xb[0], m_xb[3] - m_xb[2], m_xb[5] - m_xb[4]]
         ncell = m_ijk[0] * m_ijk[1] * m_ijk[2]
@@ -104,8 +110,21 @@ Wind rose at domain origin
 &DEVC ID='Origin_VV' XYZ=0.,0.,{(m_xb[5]-.1):.2f} QUANTITY='V-VELOCITY' /
 &DEVC ID='Origin_WV' XYZ=0.,0.,{(m_xb[5]-.1):.2f} QUANTITY='W-VELOCITY' /"""
 
+    def get_mesh_idxs(self, xs, ys):
+        """!
+        Get the FDS MESH index of points, points outside go to the nearest MESH.
+        @param xs: np.array() of points x, relative to origin.
+        @param ys: np.array() of points y, relative to origin.
+        @return np.array() of MESH indexes, in MULT order (i first, then j).
+        """
+        ixs = np.floor((xs - self.mesh_xb[0]) / self.mult_dx).astype(np.int64)
+        iys = np.floor((ys - self.mesh_xb[2]) / self.mult_dy).astype(np.int64)
+        np.clip(ixs, 0, self.nmesh_x - 1, out=ixs)
+        np.clip(iys, 0, self.nmesh_y - 1, out=iys)
+        return iys * self.nmesh_x + ixs
+
     def get_comment(self) -> str:
         return self._comment
 
-    def get_fds(self) -> str:
-        return self._fds
+    def iter_fds(self):
+        yield self._fds
@@ -27,6 +27,9 @@ class FDSCase:
         terrain,
         texture,
         wind,
+        buildings=None,
+        vegetation=None,
+        devices=None,
     ) -> None:
         self.feedback = feedback
         self.name = name  # chid
@@ -38,11 +41,15 @@ class FDSCase:
         self.terrain = terrain
         self.texture = texture
         self.wind = wind
+        self.buildings = buildings
+        self.vegetation = vegetation
+        self.devices = devices
 
         self.filename = f"{name}.fds"
         self.filepath = os.path.join(path, self.filename)
 
-    def get_fds(self):
+    def iter_fds(self):
+        """Get the FDS text, by chunks."""
         # Init
         plugin_version = pluginMetadata("qgis2fds", "version")
         qgis_version = Qgis.QGIS_VERSION.encode("ascii", "ignore").decode("ascii")
@@ -54,12 +61,21 @@ class FDSCase:
         fire_layer_desc = (
             f"{self.terrain.fire_layer and self.terrain.fire_layer.name() or 'none'}"
         )
+        building_layer_desc = (
+            self.buildings and self.buildings.get_comment() or "Building layer: none"
+        )
+        vegetation_layer_desc = (
+            self.vegetation and self.vegetation.get_comment() or "Vegetation layer: none"
+        )
+        devc_layer_desc = (
+            self.devices and self.devices.get_comment() or "FDS DEVCs layer: none"
+        )
         wind_filepath = (
             f"{self.wind.filepath and utils.shorten(self.wind.filepath) or 'none'}"
         )
 
         # Prepare fds case
-        return f"""\
+        yield f"""\
 ! Generated by qgis2fds {plugin_version} on QGIS {qgis_version}
 ! QGIS file: {utils.shorten(qgis_filepath)}
 ! Date: {date}
@@ -69,7 +85,9 @@ DEM layer: {self.dem_layer.name()}
 Landuse layer: {landuse_layer_desc}
 Landuse type file: {landuse_type_filepath}
 Fire layer: {fire_layer_desc}
-FDS DEVCs layer: FIXME
+{building_layer_desc}
+{vegetation_layer_desc}
+{devc_layer_desc}
 Wind file: {wind_filepath}
 
 &HEAD CHID='{self.name}' TITLE='Description of {self.name}' /
@@ -92,24 +110,42 @@ MISC LEVEL_SET_MODE parameter
 Example REAC, used when LEVEL_SET_MODE=4
 _REAC ID='Wood' SOOT_YIELD=0.005 O=2.5 C=3.4 H=6.2
       HEAT_OF_COMBUSTION=17700. /
-{self.domain.get_fds()}
-{self.terrain.landuse_type.get_fds()}
+"""
+        yield from self.domain.iter_fds()
+        yield "\n"
+        yield from self.terrain.landuse_type.iter_fds()
+        yield f"""
 
 Output quantities
 &SLCF AGL_SLICE=5. QUANTITY='LEVEL SET VALUE' /
 &SLCF AGL_SLICE=5. QUANTITY='TEMPERATURE' VECTOR=T /
 &SLCF PBX={0.:.2f} QUANTITY='TEMPERATURE' VECTOR=T /
 &SLCF PBY={0.:.2f} QUANTITY='TEMPERATURE' VECTOR=T /
-{self.wind.get_fds()}
-{self.terrain.get_fds()}
+"""
+        yield from self.wind.iter_fds()
+        yield "\n"
+        yield from self.terrain.iter_fds()
+        if self.buildings:
+            yield "\n"
+            yield from self.buildings.iter_fds()
+        if self.vegetation:
+            yield "\n"
+            yield from self.vegetation.iter_fds()
+        if self.devices:
+            yield "\n"
+            yield from self.devices.iter_fds()
+        yield """
 
 &TAIL /
 """
 
     def save(self):
         self.feedback.pushInfo(f"Write the fds case to <{self.filepath}>...")
-        utils.write_file(
-            feedback=self.feedback,
-            filepath=self.filepath,
-            content=self.get_fds(),
-        )
+        try:
+            utils.write_file(
+                feedback=self.feedback,
+                filepath=self.filepath,
+                content=self.iter_fds(),
+            )
+        finally:
+            self.terrain.close()  # also when canceled or failed
@@ -8,6 +8,7 @@ __copyright__ = "(C) 2020 by Emanuele Gissi"
 __revision__ = "$Format:%H$"  # replaced with git SHA1
 
 import csv, re, os
+import numpy as np
 from qgis.core import QgsProcessingException
 from . import utils
 
@@ -39,6 +40,7 @@ class LanduseType:
             self.feedback.pushInfo(f"No landuse type *.csv file.")
             self.surf_dict = {}  # INERT is predefined, FDS SURF not needed
             self.surf_id_dict = {0: "INERT"}
+        self._init_lut()
         self.feedback.pushInfo(
             f"Default bcs for the fire layer: bc_in=<{self.bc_in_default}>, bc_out=<{self.bc_out_default}>."
         )
@@ -69,15 +71,81 @@ class LanduseType:
                 f"Duplicated FDS ID in landuse type *.csv file not allowed."
             )
 
+    def _init_lut(self) -> None:
+        """Init the dense lookup table, from landuse to SURF index."""
+        keys = np.fromiter(self.surf_id_dict, dtype=np.int64)
+        self._min_key = keys.min(initial=0)
+        self._lut = np.full(keys.max(initial=0) - self._min_key + 1, -1, dtype=np.int32)
+        self._lut[keys - self._min_key] = np.arange(len(keys), dtype=np.int32)
+        self._unknown_counts = dict()  # eg: {7: 1024}
+
     def get_comment(self) -> str:
         return f"Landuse type file: <{self.filepath and utils.shorten(self.filepath) or 'none'}>"
 
-    def get_fds(self) -> str:
+    def iter_fds(self):
         res = "\n".join(self.surf_dict.values())
-        return f"""
+        yield f"""
 Landuse boundary conditions
 {res or 'none'}"""
 
+    def get_surf_idxs(self, landuses, report=True):
+        """!
+        Translate landuses into indexes of the FDS SURF_ID list, by a lookup table.
+        @param landuses: np.array() of landuse integers.
+        @param report: report unknown landuses now, else count them for later.
+        @return np.array() of int32 indexes, unknown landuses are set to 0.
+        """
+        lut, min_key = self._lut, self._min_key
+
+        # Translate, protecting from out of range landuses
+        lus = np.asarray(landuses).astype(np.int64) - min_key
+        is_in = (lus >= 0) & (lus < len(lut))
+        idxs = np.full(lus.shape, -1, dtype=np.int32)
+        idxs[is_in] = lut[lus[is_in]]
+
+        # Count unknown landuses
+        is_unknown = idxs == -1
+        if is_unknown.any():
+            values, counts = np.unique(lus[is_unknown] + min_key, return_counts=True)
+            for value, count in zip(values.tolist(), counts.tolist()):
+                self._unknown_counts[value] = self._unknown_counts.get(value, 0) + count
+            idxs[is_unknown] = 0
+        if report:
+            self.report_unknown_landuses()
+        return idxs
+
+    def get_landuses(self, values, report=True):
+        """!
+        Cast landuse values to uint16 landuses, protecting from out of range values.
+        @param values: np.array() of landuse values.
+        @param report: report out of range landuses now, else count them for later.
+        @return np.array() of uint16 landuses, out of range landuses are set to the
+        landuse of the first SURF_ID.
+        """
+        values = np.asarray(values)
+        is_in = (values >= 0) & (values <= np.iinfo(np.uint16).max)
+        if is_in.all():
+            return values.astype(np.uint16)
+
+        # Count out of range landuses, as unknown
+        unknowns, counts = np.unique(values[~is_in], return_counts=True)
+        for value, count in zip(unknowns.tolist(), counts.tolist()):
+            self._unknown_counts[value] = self._unknown_counts.get(value, 0) + count
+        if report:
+            self.report_unknown_landuses()
+        first = next(iter(self.surf_id_dict))
+        default = first if 0 <= first <= np.iinfo(np.uint16).max else 0
+        return np.where(is_in, values, default).astype(np.uint16)
+
+    def report_unknown_landuses(self) -> None:
+        """Report the counted unknown landuses, once each, and reset."""
+        surf_id = next(iter(self.surf_id_dict.values()))
+        for value, count in sorted(self._unknown_counts.items()):
+            self.feedback.reportError(
+                f"Unknown landuse index <{value}> ({count} times), setting <{surf_id}>."
+            )
+        self._unknown_counts.clear()
+
     @property
     def surf_id_str(self):
         return ",".join((f"'{s}'" for s in self.surf_id_dict.values()))
@@ -9,62 +9,244 @@ __revision__ = "$Format:%H$"  # replaced with git SHA1
 
 import os
 import numpy as np
-from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingException, QgsFeatureRequest, QgsWkbTypes
+
+try:
+    from scipy.ndimage import distance_transform_edt
+except ImportError:
+    distance_transform_edt = None
 from . import utils
 
 
+# Row tile kernels, run by row blocks to limit the temporaries
+
+
+def _get_grid_xys(grid, i, j):
+    """!
+    Get the x, y of matrix positions of a regular grid.
+    @param grid: x0, y0, dx, dy of the grid.
+    @param i: np.array() of row positions.
+    @param j: np.array() of col positions.
+    @return np.array() of x and y.
+    """
+    x0, y0, dx, dy = grid
+    return x0 + j * dx, y0 + i * dy
+
+
+def _fill_verts_zs(arrays, r0, r1):
+    """!
+    Fill the verts z of rows r0:r1, as average of surrounding centers.
+    @param arrays: dict of np.array() 'zs' of centers z with ghost centers, and 'vzs' of verts z.
+    @param r0: first row.
+    @param r1: last row + 1.
+    """
+    zs, vzs = arrays["zs"][r0 : r1 + 1], arrays["vzs"][r0:r1]  # one row of halo
+    np.add(zs[:-1, :-1], zs[1:, :-1], out=vzs)
+    vzs += zs[:-1, 1:]
+    vzs += zs[1:, 1:]
+    vzs /= 4.0
+
+
+def _fill_faces(arrays, r0, r1):
+    """!
+    Fill the two faces of the quad faces of rows r0:r1, in FDS notation.
+    @param arrays: dict of np.array() 'faces', shape (nrows, ncols, 2, 3).
+    @param r0: first row.
+    @param r1: last row + 1.
+    """
+    faces = arrays["faces"][r0:r1]
+    ncols = faces.shape[1]
+    len_vcol = ncols + 1  # vert matrix is larger
+
+    # Vert index of the top left corner of each quad face, by row,
+    # F90 indexes start from 1
+    v00 = (
+        np.arange(r0, r1, dtype=np.int32)[:, np.newaxis] * len_vcol
+        + np.arange(ncols, dtype=np.int32)
+        + 1
+    )
+    v01, v10 = v00 + 1, v00 + len_vcol
+    v11 = v10 + 1
+
+    # Two faces for each quad face
+    faces[:, :, 0, 0], faces[:, :, 0, 1], faces[:, :, 0, 2] = v00, v10, v01  # 1st
+    faces[:, :, 1, 0], faces[:, :, 1, 1], faces[:, :, 1, 2] = v11, v01, v10  # 2nd
+
+
+def _fill_face_landuses(arrays, r0, r1):
+    """!
+    Fill the landuses of the two faces of the quad faces of rows r0:r1.
+    @param arrays: dict of np.array() 'lus' of centers landuse, and 'landuses', shape (nrows, ncols, 2).
+    @param r0: first row.
+    @param r1: last row + 1.
+    """
+    lus, landuses = arrays["lus"][r0:r1], arrays["landuses"][r0:r1]
+    landuses[:, :, 0], landuses[:, :, 1] = lus, lus  # same landuse for both faces
+
+
+def _fill_obst_xbs(arrays, r0, r1, grid, min_z):
+    """!
+    Fill the OBST XBs of rows r0:r1.
+    @param arrays: dict of np.array() 'zs' of centers z, and 'xbs', shape (nrows, ncols, 6).
+    @param r0: first row.
+    @param r1: last row + 1.
+    @param grid: x0, y0, dx, dy of the centers grid.
+    @param min_z: OBST bottom.
+    """
+    zs, xbs = arrays["zs"][r0:r1], arrays["xbs"][r0:r1]
+    i, j = np.arange(r0, r1)[:, np.newaxis], np.arange(zs.shape[1])
+
+    # Calc all the OBST corners, halfway to the diagonal centers
+    p0x, p0y = _get_grid_xys(grid, i + 0.5, j - 0.5)
+    p1x, p1y = _get_grid_xys(grid, i - 0.5, j + 0.5)
+
+    # Fill the XBs, widening to float64
+    xbs[:, :, 0], xbs[:, :, 1] = p0x, p1x
+    xbs[:, :, 2], xbs[:, :, 3] = p0y, p1y
+    xbs[:, :, 4], xbs[:, :, 5] = min_z, zs
+
+
+# GEOM terrain
+
+
 class GEOMTerrain:
     def __init__(
         self,
         feedback,
         sampling_layer,
+        sampling_shape,
         utm_origin,
         landuse_layer,
         landuse_type,
         fire_layer,
         path,
         name,
+        cell_size=None,  # unused
+        merge_obsts=False,  # unused
+        snap_obsts=None,  # unused
+        geom_tolerance=None,
+        split_terrain=False,
+        text_nprocs=None,
+        memory_budget=None,
+        lod_distance=None,
+        utm_fire_layer=None,
+        sampling_arrays=None,
     ) -> None:
         self.feedback = feedback
         self.sampling_layer = sampling_layer
+        self.sampling_shape = sampling_shape
         self.utm_origin = utm_origin
         self.landuse_layer = landuse_layer
         self.landuse_type = landuse_type
         self.fire_layer = fire_layer
+        self.geom_tolerance = geom_tolerance
+        self.split_terrain = split_terrain
+        self.text_nprocs = text_nprocs
+        self.memory_budget = memory_budget  # in MB
+        self.lod_distance = lod_distance
+        self.utm_fire_layer = utm_fire_layer
+        self.sampling_arrays = sampling_arrays  # instead of sampling_layer
 
         self._filename = f"{name}_terrain.bingeom"
         self._filepath = os.path.join(path, self._filename)
 
-        self._m = None
+        self._init_scratch(path=path, name=name)
+
+        self._grid = None  # x0, y0, dx, dy of the centers, relative to origin
+        self._zs = None  # z of the centers, as _z_dtype
+        self._lus = None  # uint16 landuse of the centers
         self.min_z = 0.0
         self.max_z = 0.0
         self._init_matrix()
 
         if self.feedback.isCanceled():
-            return {}
+            return
+
+        self._inject_ghost_centers()
 
-        self._faces = list()
-        self._landuses = list()
-        self._init_faces_and_landuses()
+    # Estimated size of the terrain arrays per quad face, in bytes:
+    # centers z, ghost z, landuse, verts z, faces, faces landuses
+    _cell_nbytes = 4 + 4 + 2 + 4 + 24 + 4
 
-        if self.feedback.isCanceled():
-            return {}
+    # Centers z are float32, as the GEOM verts z
+    _z_dtype = np.float32
+
+    def _init_scratch(self, path, name):
+        """Init the allocator of the large arrays, within the memory budget."""
+        nrows, ncols = self.sampling_shape
+        nbytes = nrows * ncols * self._cell_nbytes
+        budget = self.memory_budget and self.memory_budget * 2**20
+        use_memmap = bool(budget) and nbytes > budget
+        self._scratch = utils.ScratchArrays(
+            path=path, prefix=f"{name}_terrain", use_memmap=use_memmap
+        )
+        self._block_rows = None  # no row blocks
+        if use_memmap:
+            # Row blocks temporaries stay within a fraction of the budget
+            self._block_rows = max(int(budget // (4 * ncols * self._cell_nbytes)), 1)
+            self.feedback.pushInfo(
+                f"Terrain arrays of {nbytes / 2**20:.0f} MB exceed the {self.memory_budget} MB budget, use scratch files in <{path}> and blocks of {self._block_rows} rows."
+            )
+            if self.text_nprocs and self.text_nprocs > 1:
+                self.feedback.pushInfo(
+                    "Serial terrain text formatting, to stay within budget."
+                )
+                self.text_nprocs = None
+        # One process pool for the OBST and ZVALS terrain text,
+        # started when first needed
+        self._pool = None
+        if self.text_nprocs and self.text_nprocs > 1:
+            self._pool = utils.ProcessPool(
+                feedback=self.feedback, nprocs=self.text_nprocs
+            )
+
+    def _run_row_tiles(self, func, arrays, nrows, **kwargs):
+        """Run func on row tiles, with the terrain memory settings."""
+        utils.run_row_tiles(
+            func=func,
+            arrays=arrays,
+            nrows=nrows,
+            block_rows=self._block_rows,
+            **kwargs,
+        )
+
+    def close(self):
+        """Remove the scratch files, and shut the process pool down, if not yet."""
+        self._scratch.close()
+        if self._pool:
+            self._pool.close()
+
+    def set_domain(self, domain) -> None:
+        """Set the FDS domain, and init the terrain on it."""
+        self.domain = domain
 
-        self._verts = list()
         self._init_verts()
 
-    # The layer is a flat list of quad faces center points (z, x, y, landuse)
-    # ordered by column. The original flat list is cut in columns, when three consecutive points
-    # form an angle < 180°.
-    # The returned matrix is a topological 2D representation of them by row (when transposed).
+        if self.feedback.isCanceled():
+            return
+
+        lod_levels = self._get_lod_levels()
+
+        if self.geom_tolerance or lod_levels is not None:
+            self._simplify(lod_levels=lod_levels)
+        else:
+            self._init_faces_and_landuses()
 
-    # Same column:  following column:
-    #      first ·            first · · current
-    #            |                  | ^
-    #            |                  | |
-    #       prev ·                  | |
-    #            |                  |/
-    #    current ·             prev ·
+    # The layer is a flat list of quad faces center points (x, y, z, landuse)
+    # ordered by column, as created by native:creategrid:
+    # each column goes from top to bottom, columns go from left to right.
+    # As the grid shape (nrows, ncols) is known, the flat lists of z and landuse
+    # are reshaped to (ncols, nrows) and transposed: the returned matrices are
+    # a topological 2D representation of them by row, without copies.
+    # As the grid is regular, the center x, y are not stored,
+    # they are implicit in the matrix position: x = x0 + j·dx, y = y0 + i·dy
+
+    # columns:  0   1   2
+    #           · ┌>· ┌>·
+    #           | | | | |
+    #           · | · | ·
+    #           | | | | |
+    #           ·─┘ ·─┘ ·
 
     # matrix:    j
     #      o   o   o   o   o
@@ -80,74 +262,110 @@ class GEOMTerrain:
 
     def _init_matrix(self) -> None:
         """Init the matrix from the sampling layer."""
+        if self.sampling_arrays is not None:
+            self._init_matrix_from_arrays()
+            return
         self.feedback.pushInfo("Init the matrix of sampling points...")
         self.feedback.setProgress(0)
 
         # Init
         sampling_layer = self.sampling_layer
+        nrows, ncols = self.sampling_shape
         nfeatures = sampling_layer.featureCount()
-        partial_progress = nfeatures // 100 or 1
-        m = np.empty((nfeatures, 4))  # allocate the np array
-        ox, oy = self.utm_origin.x(), self.utm_origin.y()  # get origin
-
-        # Fill the array with point coordinates, points are listed by column
-        # calc min and max z
-        min_z, max_z = 1e6, -1e6
-        for i, f in enumerate(self.sampling_layer.getFeatures()):
-            g = f.geometry().get()  # QgsPoint
-            z = g.z()
-            if z > max_z:
-                max_z = z
-            if z < min_z:
-                min_z = z
-            m[i] = (
-                g.x() - ox,  # x, relative to origin
-                g.y() - oy,  # y, relative to origin
-                g.z(),  # z absolute
-                0,  # for landuse
+        if nfeatures != nrows * ncols:
+            raise QgsProcessingException(
+                f"Sampling layer has {nfeatures} points instead of {nrows}x{ncols}, cannot proceed."
             )
-            if i % partial_progress == 0:
-                self.feedback.setProgress(int(i / nfeatures * 100))
-        self.max_z, self.min_z = max_z, min_z
+        if nrows < 2 or ncols < 2:
+            raise QgsProcessingException(
+                f"Sampling layer has {nrows}x{ncols} points, at least 2x2 needed, cannot proceed."
+            )
+        zs = self._scratch.empty(nfeatures, self._z_dtype)  # allocate the np arrays
+        lus = self._scratch.zeros(nfeatures, np.uint16)  # default landuse
+        ox, oy = self.utm_origin.x(), self.utm_origin.y()  # get origin
 
-        # Fill the array with the landuse
+        # Request only the needed attributes
+        fields = sampling_layer.fields()
+        landuse_idx, bc_idx = -1, -1
         if self.landuse_layer:
-            landuse_idx = self.sampling_layer.fields().indexOf("landuse1")
-            for i, f in enumerate(self.sampling_layer.getFeatures()):
-                a = f.attributes()
-                m[i][3] = a[landuse_idx] or 0
-                if i % partial_progress == 0:
-                    self.feedback.setProgress(int(i / nfeatures * 100))
-
-        # Fill the array with the fire layer bcs
+            landuse_idx = fields.indexOf("landuse1")
         if self.fire_layer:
-            bc_idx = self.sampling_layer.fields().indexOf("bc")
-            for i, f in enumerate(self.sampling_layer.getFeatures()):
+            bc_idx = fields.indexOf("bc")
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes([i for i in (landuse_idx, bc_idx) if i != -1])
+
+        # Fill the arrays with point z and landuse in one pass,
+        # points are listed by column, from top left to bottom right,
+        # by chunks kept as float64 for the min and max z, and the landuse check
+        last = nfeatures - 1
+        chunk_len = min(nfeatures, 2**16)
+        chunk_zs, chunk_lus = np.empty(chunk_len), np.zeros(chunk_len)
+        min_z, max_z = np.inf, -np.inf
+        start = 0
+        for i, f in enumerate(sampling_layer.getFeatures(request)):
+            g = f.geometry().constGet()  # QgsPoint
+            k = i - start
+            chunk_zs[k] = g.z()
+            if i == 0:
+                x0, y0 = g.x(), g.y()  # top left
+            elif i == last:
+                x1, y1 = g.x(), g.y()  # bottom right
+            if landuse_idx != -1 or bc_idx != -1:
                 a = f.attributes()
-                if a[bc_idx]:
-                    m[i][3] = a[bc_idx]
-                if i % partial_progress == 0:
-                    self.feedback.setProgress(int(i / nfeatures * 100))
-
-        # Get point column length
-        column_len = 2
-        p0, p1 = m[0, :2], m[1, :2]
-        v0 = p1 - p0
-        for p2 in m[2:, :2]:
-            v1 = p2 - p1
-            if abs(np.dot(v0, v1) / np.linalg.norm(v0) / np.linalg.norm(v1)) < 0.9:
-                break  # end of point column
-            column_len += 1
-
-        # Split matrix into columns list, get np array, and transpose
-        # Now points are by row
-        m = np.array(np.split(m, nfeatures // column_len)).transpose(1, 0, 2)
-        # Check
-        if m.shape[0] < 3 or m.shape[1] < 3:
+                if landuse_idx != -1:
+                    chunk_lus[k] = a[landuse_idx] or 0
+                if bc_idx != -1 and a[bc_idx]:
+                    chunk_lus[k] = a[bc_idx]  # fire layer bc override landuse
+            if k == chunk_len - 1 or i == last:
+                n = k + 1
+                zs[start : i + 1] = chunk_zs[:n]
+                min_z = np.fmin.reduce(chunk_zs[:n], initial=min_z)  # NaN ignored
+                max_z = np.fmax.reduce(chunk_zs[:n], initial=max_z)
+                lus[start : i + 1] = self.landuse_type.get_landuses(
+                    chunk_lus[:n], report=False
+                )
+                chunk_lus[:] = 0  # default landuse
+                start = i + 1
+                self.feedback.setProgress(int(i / nfeatures * 100))
+        self._grid = (
+            x0 - ox,  # x, relative to origin
+            y0 - oy,  # y, relative to origin
+            (x1 - x0) / (ncols - 1),
+            (y1 - y0) / (nrows - 1),  # negative, rows go downward
+        )
+        self.max_z, self.min_z = float(max_z), float(min_z)
+
+        # Reshape by column and transpose (views), now points are by row
+        self._zs = zs.reshape(ncols, nrows).T
+        self._lus = lus.reshape(ncols, nrows).T
+
+    def _init_matrix_from_arrays(self) -> None:
+        """Init the matrix from the sampling raster blocks, already by row."""
+        self.feedback.pushInfo("Init the matrix of sampling raster blocks...")
+        nrows, ncols = self.sampling_shape
+        zs, lus = self.sampling_arrays["zs"], self.sampling_arrays["lus"]
+        if zs.shape != (nrows, ncols) or lus.shape != (nrows, ncols):
             raise QgsProcessingException(
-                f"[QGIS bug] Sampling matrix is too small: {m.shape[0]}x{m.shape[1]}"
+                f"Sampling blocks of {zs.shape} pixels instead of {nrows}x{ncols}, cannot proceed."
             )
-        self._m = m
+        if nrows < 2 or ncols < 2:
+            raise QgsProcessingException(
+                f"Sampling blocks have {nrows}x{ncols} pixels, at least 2x2 needed, cannot proceed."
+            )
+        x0, y0, dx, dy = self.sampling_arrays["GRID"]  # top left center
+        ox, oy = self.utm_origin.x(), self.utm_origin.y()  # get origin
+        self._grid = (x0 - ox, y0 - oy, dx, dy)
+        self.max_z, self.min_z = float(zs.max()), float(zs.min())  # before narrowing
+        self._zs = zs.astype(self._z_dtype, copy=False)
+        self._lus = lus.astype(np.uint16, copy=False)
+
+    def get_matrix(self):
+        """Get the matrix of centers z, and its grid x0, y0, dx, dy relative to origin."""
+        return self._zs[1:-1, 1:-1], self._grid  # without ghost centers
+
+    def _get_xys(self, i, j):
+        """Get the x, y of matrix positions, relative to origin."""
+        return _get_grid_xys(self._grid, i, j)
 
     def _inject_ghost_centers(self):
         """Inject ghost centers into the matrix."""
@@ -155,58 +373,51 @@ class GEOMTerrain:
         feedback.pushInfo("Inject ghost centers in matrix...")
         feedback.setProgress(0)
 
-        # Init displacements
-        dx, dy = self._m[0, 1] - self._m[0, 0], self._m[1, 0] - self._m[0, 0]
-        dx[2], dy[2] = 0.0, 0.0  # no z displacement
-        dx[3], dy[3] = 0.0, 0.0  # no landuse change
-
-        # Inject first row
-        row = tuple(c - dy for c in self._m[0, :])
-        self._m = np.insert(self._m, 0, row, axis=0)
-
-        # Append last row
-        row = tuple((tuple(c + dy for c in self._m[-1, :]),))
-        self._m = np.append(self._m, row, axis=0)
+        # Allocate the larger matrix once, and copy the original matrix inside,
+        # by row blocks
+        zs = self._zs
+        nrows, ncols = zs.shape
+        gzs = self._scratch.empty((nrows + 2, ncols + 2), np.float32)
+        block_rows = self._block_rows or nrows
+        for r0 in range(0, nrows, block_rows):
+            r1 = min(r0 + block_rows, nrows)
+            gzs[r0 + 1 : r1 + 1, 1:-1] = zs[r0:r1]
 
-        # Inject first col
-        col = tuple(c - dx for c in self._m[:, 0])
-        self._m = np.insert(self._m, 0, col, axis=1)
+        # Ghost centers have the z of their neighbours,
+        # their x, y are implicit in the regular grid
+        gzs[0, 1:-1], gzs[-1, 1:-1] = zs[0], zs[-1]
+        gzs[:, 0], gzs[:, -1] = gzs[:, 1], gzs[:, -2]
+        self._zs = gzs
 
-        # Append last col
-        col = tuple(
-            tuple((c + dx,) for c in self._m[:, -1]),
-        )
-        self._m = np.append(self._m, col, axis=1)
+    #        j   j  j+1
+    #        *<------* i
+    #        | f1 // |
+    # faces  |  /·/  | i
+    #        | // f2 |
+    #        *------>* i+1
 
     def _init_faces_and_landuses(self):
         """Init GEOM faces and landuses."""
         self.feedback.pushInfo("Init GEOM faces and their landuses...")
         self.feedback.setProgress(0)
-        m = self._m
-        len_vrow = m.shape[0]
-        len_vcol = m.shape[1] + 1  # vert matrix is larger
-        for i, row in enumerate(m):
-            for j, p in enumerate(row):
-                self._faces.extend(
-                    (
-                        (
-                            self._get_vert_index(i, j, len_vcol),  # 1st face
-                            self._get_vert_index(i + 1, j, len_vcol),
-                            self._get_vert_index(i, j + 1, len_vcol),
-                        ),
-                        (
-                            self._get_vert_index(i + 1, j + 1, len_vcol),  # 2nd face
-                            self._get_vert_index(i, j + 1, len_vcol),
-                            self._get_vert_index(i + 1, j, len_vcol),
-                        ),
-                    )
-                )
-                lu = int(p[3])
-                self._landuses.extend((lu, lu))
-            self.feedback.setProgress(int(i / len_vrow * 100))
+        nrows, ncols = self._lus.shape
+
+        # Two faces for each quad face, by row
+        faces = self._scratch.empty((nrows, ncols, 2, 3), np.int32)
+        self._run_row_tiles(func=_fill_faces, arrays={"faces": faces}, nrows=nrows)
+        self._faces = faces.reshape(-1, 3)
 
-    # First inject ghost centers all around the vertices
-    # then extract the vertices by averaging the neighbour centers coordinates
+        # Same landuse for both faces
+        landuses = self._scratch.empty((nrows, ncols, 2), np.uint16)
+        self._run_row_tiles(
+            func=_fill_face_landuses,
+            arrays={"lus": self._lus, "landuses": landuses},
+            nrows=nrows,
+        )
+        self._landuses = landuses.ravel()
+
+    # Ghost centers are injected all around the vertices,
+    # then the vertices are extracted by averaging the neighbour centers
 
     # · centers of quad faces  + ghost centers
     # o verts  * cs  x vert
@@ -221,59 +432,176 @@ class GEOMTerrain:
     #          +   +   +   +   +   +  last ghost row (skipped)
 
     def _init_verts(self):
-        """Init verts as average of surrounding centers."""
+        """Init verts z as average of surrounding centers."""
         self.feedback.pushInfo("Init GEOM verts...")
         self.feedback.setProgress(0)
 
-        self._inject_ghost_centers()
-        m = self._m
-        ncenters = m.shape[0] * m.shape[1]
-        partial_progress = ncenters // 100 or 1
-        # Skip last row and last col
-        for ip, idxs in enumerate(np.ndindex(m.shape[0] - 1, m.shape[1] - 1)):
-            i, j = idxs
-            self._verts.append(
-                (m[i, j, :3] + m[i + 1, j, :3] + m[i, j + 1, :3] + m[i + 1, j + 1, :3])
-                / 4.0
+        nrows, ncols = self._lus.shape
+
+        # The vert x, y are at the matrix positions i - 0.5, j - 0.5
+        vzs = self._scratch.empty((nrows + 1, ncols + 1), np.float32)
+        self._run_row_tiles(
+            func=_fill_verts_zs,
+            arrays={"zs": self._zs, "vzs": vzs},  # with ghost centers
+            nrows=nrows + 1,
+        )
+        self._vzs = vzs.ravel()
+        self._vijs = None  # all verts, by row
+
+    def _get_lod_levels(self):
+        """Get the quad faces level of detail, by their distance from the fire layer."""
+        feedback = self.feedback
+        if not self.lod_distance:
+            return None
+        if not self.utm_fire_layer:
+            feedback.pushInfo("No fire layer, full resolution everywhere.")
+            return None
+        if not distance_transform_edt:
+            feedback.reportError("SciPy not available, full resolution everywhere.")
+            return None
+        lod_distance = self.lod_distance
+        feedback.pushInfo(
+            f"Init the level of detail, full resolution within <{lod_distance}m> from the fire layer..."
+        )
+
+        # Get the distance of each quad face from the fire quad faces
+        is_fire = self._get_fire_cells()
+        if not is_fire.any():
+            feedback.pushInfo(
+                "Fire layer outside the terrain, full resolution everywhere."
             )
-            if ip % partial_progress == 0:
-                self.feedback.setProgress(int(ip / ncenters * 100))
+            return None
+        _, _, dx, dy = self._grid
+        ds = distance_transform_edt(~is_fire, sampling=(abs(dy), abs(dx)))
 
-    #        j   j  j+1
-    #        *<------* i
-    #        | f1 // |
-    # faces  |  /·/  | i
-    #        | // f2 |
-    #        *------>* i+1
+        # Get the quadtree level of each quad face, by row blocks:
+        # full resolution within distance, then a level more each doubling
+        nrows, ncols = ds.shape
+        lod_levels = self._scratch.empty((nrows, ncols), np.int8)
+        block_rows = self._block_rows or nrows
+        for r0 in range(0, nrows, block_rows):
+            r1 = min(r0 + block_rows, nrows)
+            bds = ds[r0:r1]
+            ratios = np.maximum(bds / lod_distance, 1.0)
+            lod_levels[r0:r1] = np.where(
+                bds <= lod_distance, 0, np.minimum(np.floor(np.log2(ratios)) + 1, 127)
+            )
+        feedback.pushInfo(
+            f"{np.count_nonzero(lod_levels == 0)} of {nrows * ncols} terrain cells at full resolution."
+        )
+        return lod_levels
+
+    def _get_fire_cells(self):
+        """Get the quad faces touched by the fire layer, or centered inside it."""
+        nrows, ncols = self._lus.shape
+        x0, y0, dx, dy = self._grid
+        xs, ys = self._get_xys(np.arange(nrows), np.arange(ncols))
+        ox, oy = self.utm_origin.x(), self.utm_origin.y()
+        is_fire = np.zeros((nrows, ncols), dtype=bool)
+        request = QgsFeatureRequest().setNoAttributes()
+        for f in self.utm_fire_layer.getFeatures(request):
+            g = f.geometry()
+            if g.isNull() or g.isEmpty():
+                continue
+
+            # Quad faces of the verts, densified to half a quad face,
+            # so that boundaries, lines and points are never skipped
+            g = g.densifyByDistance(min(abs(dx), abs(dy)) / 2.0)
+            vxys = np.array([(v.x() - ox, v.y() - oy) for v in g.vertices()])
+            i = np.rint((vxys[:, 1] - y0) / dy).astype(int)
+            j = np.rint((vxys[:, 0] - x0) / dx).astype(int)
+            is_in = (i >= 0) & (i < nrows) & (j >= 0) & (j < ncols)
+            is_fire[i[is_in], j[is_in]] = True
+            if g.type() != QgsWkbTypes.PolygonGeometry:
+                continue
+
+            # Quad faces with their center inside the polygons,
+            # by even-odd crossings of the ring edges along each row
+            polygons = g.asMultiPolygon() if g.isMultipart() else (g.asPolygon(),)
+            edges = list()  # x0, y0, x1, y1
+            for ring in (ring for polygon in polygons for ring in polygon):
+                rxys = np.array([(p.x() - ox, p.y() - oy) for p in ring])
+                edges.append(np.column_stack((rxys[:-1], rxys[1:])))
+            if not edges:
+                continue
+            ex0, ey0, ex1, ey1 = np.concatenate(edges).T
+            r0 = max(int(np.ceil((max(ey0.max(), ey1.max()) - y0) / dy)), 0)
+            r1 = min(int(np.floor((min(ey0.min(), ey1.min()) - y0) / dy)) + 1, nrows)
+            for r in range(r0, r1):
+                is_crossed = (ey0 <= ys[r]) != (ey1 <= ys[r])
+                t = (ys[r] - ey0[is_crossed]) / (ey1[is_crossed] - ey0[is_crossed])
+                cxs = np.sort(ex0[is_crossed] + t * (ex1[is_crossed] - ex0[is_crossed]))
+                is_fire[r] |= np.searchsorted(cxs, xs) % 2 == 1
+        return is_fire
+
+    def _simplify(self, lod_levels=None):
+        """Init simplified GEOM verts, faces and their landuses."""
+        feedback = self.feedback
+        if self.geom_tolerance:
+            feedback.pushInfo(
+                f"Simplify GEOM with <{self.geom_tolerance}m> vertical tolerance..."
+            )
+        if lod_levels is not None:
+            feedback.pushInfo("Simplify GEOM by level of detail...")
+        nrows, ncols = self._lus.shape
+        self._vijs, self._vzs, self._faces, self._landuses = get_simplified_geom(
+            zs=self._vzs.reshape(nrows + 1, ncols + 1),
+            landuses=self._lus,
+            tolerance=self.geom_tolerance,
+            lod_levels=lod_levels,
+        )
+        nfaces = 2 * nrows * ncols
+        feedback.pushInfo(
+            f"{nfaces} faces simplified into {len(self._faces)} ({nfaces / len(self._faces):.1f}x reduction)."
+        )
+
+    def _get_vert_ijs(self, idxs):
+        """Get the vert matrix positions of vert indexes."""
+        if self._vijs is None:  # all verts, by row
+            return np.divmod(idxs, self._lus.shape[1] + 1)
+        return self._vijs[idxs, 0], self._vijs[idxs, 1]
+
+    def _get_fds_verts(self, idxs=None, chunk_len=2**16):
+        """Get the verts, or the selected ones, widened to float64 by chunks."""
+        nverts = len(self._vzs) if idxs is None else len(idxs)
+
+        def get_chunks():
+            for start in range(0, nverts, chunk_len):
+                sel = np.arange(start, min(start + chunk_len, nverts))
+                if idxs is not None:
+                    sel = idxs[sel]
+                i, j = self._get_vert_ijs(sel)
+                verts = np.empty((len(sel), 3))
+                verts[:, 0], verts[:, 1] = self._get_xys(i - 0.5, j - 0.5)
+                verts[:, 2] = self._vzs[sel]
+                yield verts
 
-    def _get_vert_index(self, i, j, len_vcol):
-        """Get vert index in FDS notation."""
-        return i * len_vcol + j + 1  # F90 indexes start from 1
+        return utils.ChunkedArray(chunks=get_chunks(), length=3 * nverts)
 
-    def _save_bingeom(self) -> None:
+    def _save_bingeom(self, filepath, verts, faces, landuses, chunk_len=2**20) -> None:
         """Save the bingeom file."""
 
-        # Format in fds notation
-        fds_verts = tuple(v for vs in self._verts for v in vs)
-        fds_faces = tuple(f for fs in self._faces for f in fs)
-        fds_surfs = list()
-
-        # Translate landuse_layer landuses into FDS SURF index
-        surf_id_list = list(self.landuse_type.surf_id_dict)
-        n_surf_id = len(surf_id_list)
-        for i, _ in enumerate(self._faces):
-            lu = self._landuses[i]
-            try:
-                fds_surfs.append(surf_id_list.index(lu) + 1)  # +1 for F90
-            except ValueError:
-                self.feedback.reportError(f"Unknown landuse index <{lu}>, setting <0>.")
-                fds_surfs.append(1)  # 0 + 1 for F90
-        fds_surfs = tuple(fds_surfs)
+        # Format in fds notation, as views
+        fds_verts = verts
+        fds_faces = faces.ravel()
+
+        # Translate landuse_layer landuses into FDS SURF index, by chunks
+        n_surf_id = len(self.landuse_type.surf_id_dict)
+        fds_surfs = utils.ChunkedArray(
+            chunks=(
+                self.landuse_type.get_surf_idxs(
+                    landuses[i : i + chunk_len], report=False
+                )
+                + 1  # +1 for F90
+                for i in range(0, len(landuses), chunk_len)
+            ),
+            length=len(landuses),
+        )
 
         # Write bingeom
         utils.write_bingeom(
             feedback=self.feedback,
-            filepath=self._filepath,
+            filepath=filepath,
             geom_type=2,
             n_surf_id=n_surf_id,
             fds_verts=fds_verts,
@@ -282,95 +610,863 @@ class GEOMTerrain:
             fds_volus=list(),
         )
 
+    def _iter_mesh_geoms(self):
+        """Get verts, faces and landuses of each FDS MESH, by faces center."""
+        faces = self._faces - 1  # F90 indexes start from 1
+        i, j = self._get_vert_ijs(faces)
+        xs, ys = self._get_xys(i.mean(axis=1) - 0.5, j.mean(axis=1) - 0.5)
+        d = self.domain
+        mesh_idxs = d.get_mesh_idxs(xs, ys)
+        for mesh_idx, sel in enumerate(get_parts(mesh_idxs, d.nmesh_x * d.nmesh_y)):
+            if self.feedback.isCanceled():
+                return
+            mesh_faces = faces[sel]
+            # Keep the used verts only, and renumber them
+            used_verts = np.unique(mesh_faces)
+            mesh_faces = np.searchsorted(used_verts, mesh_faces).astype(np.int32)
+            mesh_faces += 1
+            yield mesh_idx, used_verts, mesh_faces, self._landuses[sel]
 
-
-    def get_fds(self) -> str:
-        """Get the FDS text and save."""
-        self._save_bingeom()
+    def iter_fds(self):
+        """Get the FDS text, by chunks, and save."""
+        if self.split_terrain:
+            yield from self._iter_split_fds()
+            return
+        self._save_bingeom(
+            filepath=self._filepath,
+            verts=self._get_fds_verts(),
+            faces=self._faces,
+            landuses=self._landuses,
+        )
+        self.landuse_type.report_unknown_landuses()
+        self.close()
         self.feedback.pushInfo(f"GEOM terrain ready.")
-        return f"""
-Terrain ({len(self._verts)} verts, {len(self._faces)} faces)
+        yield f"""
+Terrain ({len(self._vzs)} verts, {len(self._faces)} faces)
 &GEOM ID='Terrain'
       SURF_ID={self.landuse_type.surf_id_str}
       BINARY_FILE='{self._filename}'
       IS_TERRAIN=T EXTEND_TERRAIN=F /"""
 
+    def _iter_split_fds(self):
+        """Get the FDS text split by FDS MESH, by chunks, and save."""
+        nmesh_x = self.domain.nmesh_x
+        root, ext = os.path.splitext(self._filename)
+        yield f"""
+Terrain ({len(self._vzs)} verts, {len(self._faces)} faces), split by MESH"""
+        for mesh_idx, used_verts, faces, landuses in self._iter_mesh_geoms():
+            if not len(faces):
+                continue
+            j, i = divmod(mesh_idx, nmesh_x)
+            filename = f"{root}_{i}_{j}{ext}"
+            self._save_bingeom(
+                filepath=os.path.join(os.path.dirname(self._filepath), filename),
+                verts=self._get_fds_verts(used_verts),
+                faces=faces,
+                landuses=landuses,
+            )
+            yield f"""
+Terrain of MESH {i},{j} ({len(used_verts)} verts, {len(faces)} faces)
+&GEOM ID='Terrain_{i}_{j}'
+      SURF_ID={self.landuse_type.surf_id_str}
+      BINARY_FILE='{filename}'
+      IS_TERRAIN=T EXTEND_TERRAIN=F /"""
+        self.landuse_type.report_unknown_landuses()
+        self.close()
+        self.feedback.pushInfo(f"GEOM terrain ready.")
+
+
+# GEOM terrain simplification
+
+# Quad faces are merged in square blocks of 2^level size, as in a quadtree.
+# Blocks are triangulated along the same diagonal of the quad faces,
+# or by a fan around a new center vert, when neighbour smaller blocks
+# inject verts on their edges. So the triangulation is always watertight.
+
+#         block     fan
+#        *<------*  *<--*--*
+#        | f1 // |  |\\ | /|
+#        |  /·/  |  *--·--*
+#        | // f2 |  |/ | \\|
+#        *------>*  *--*-->*
+
+
+def _get_block_children(a, nbrows, nbcols):
+    """!
+    Get the four children of each block of the upper quadtree level.
+    @param a: np.array() of the lower level, shape (nrows, ncols).
+    @param nbrows: number of block rows of the upper level.
+    @param nbcols: number of block cols of the upper level.
+    @return np.array() of children, shape (nbrows, nbcols, 4).
+    """
+    return (
+        a[: 2 * nbrows, : 2 * nbcols]
+        .reshape(nbrows, 2, nbcols, 2)
+        .transpose(0, 2, 1, 3)
+        .reshape(nbrows, nbcols, 4)
+    )
+
+
+def _get_majorities(children):
+    """!
+    Get the most frequent of the four children values, ties to the first.
+    @param children: np.array() of children, shape (nbrows, nbcols, 4).
+    @return np.array() of values, shape (nbrows, nbcols).
+    """
+    counts = (children[:, :, :, np.newaxis] == children[:, :, np.newaxis, :]).sum(axis=3)
+    idxs = counts.argmax(axis=2)[:, :, np.newaxis]
+    return np.take_along_axis(children, idxs, axis=2)[:, :, 0]
+
+
+def _get_quadtree_leaves(mergeables, nrows, ncols):
+    """!
+    Select the leaf blocks of the quadtree, from the largest level.
+    @param mergeables: list of np.array() of mergeable blocks, by level (level 0 is None).
+    @param nrows: number of matrix rows.
+    @param ncols: number of matrix cols.
+    @return list of np.array() of leaf block rows and cols, by level.
+    """
+    nlevels = len(mergeables)
+    leaves = [None] * nlevels
+    is_covered = np.zeros((0, 0), dtype=bool)
+    for level in range(nlevels - 1, -1, -1):
+        size = 2**level
+        nbrows, nbcols = nrows // size, ncols // size
+        is_parent_covered = np.zeros((nbrows, nbcols), dtype=bool)
+        is_parent_covered[: 2 * is_covered.shape[0], : 2 * is_covered.shape[1]] = (
+            is_covered.repeat(2, axis=0).repeat(2, axis=1)
+        )
+        if level:
+            is_leaf = mergeables[level] & ~is_parent_covered
+        else:
+            is_leaf = ~is_parent_covered  # remaining cells
+        is_covered = is_parent_covered | is_leaf
+        leaves[level] = np.nonzero(is_leaf)
+    return leaves
+
+
+def get_simplified_geom(zs, landuses, tolerance=None, lod_levels=None):
+    """!
+    Simplify the regular GEOM terrain by merging quad faces in quadtree blocks.
+    Blocks are merged when their quad faces have the same landuse,
+    and the vertical error of their verts is below tolerance.
+    Blocks are merged anyway up to the level of detail of their quad faces,
+    taking the most frequent landuse.
+    @param zs: np.array() of verts z, shape (nrows + 1, ncols + 1).
+    @param landuses: np.array() of quad faces landuses, shape (nrows, ncols).
+    @param tolerance: max vertical error, if None no merging by error.
+    @param lod_levels: np.array() of quad faces max quadtree level, if None no level of detail.
+    @return np.array() of verts matrix positions (i, j), verts z,
+    faces in FDS notation, and faces landuses.
+    """
+    nrows, ncols = landuses.shape
+
+    # Get mergeable blocks, level by level,
+    # a block is mergeable if its four children are mergeable
+    mergeables, block_lus = [None], [landuses]  # level 0, quad faces
+    block_lods = lod_levels
+    size = 2
+    while size <= min(nrows, ncols):
+        level = len(mergeables)
+        nbrows, nbcols = nrows // size, ncols // size
+        is_mergeable = np.zeros((nbrows, nbcols), dtype=bool)
+        children_lus = _get_block_children(block_lus[-1], nbrows, nbcols)
+        lus = children_lus[:, :, 0]
+        if tolerance is not None:
+            # Get children
+            is_children_ok = np.ones((nbrows, nbcols), dtype=bool)
+            if mergeables[-1] is not None:
+                is_children_ok = _get_block_children(
+                    mergeables[-1], nbrows, nbcols
+                ).all(axis=2)
+            is_mergeable = is_children_ok & (
+                children_lus == lus[:, :, np.newaxis]
+            ).all(axis=2)
+            # Check vertical error of candidate blocks verts
+            bis, bjs = np.nonzero(is_mergeable)
+            windows = np.lib.stride_tricks.sliding_window_view(
+                zs, (size + 1, size + 1)
+            )
+            chunk_len = max(2**20 // (size + 1) ** 2, 1)  # by chunks, to limit memory
+            for start in range(0, len(bis), chunk_len):
+                bi, bj = bis[start : start + chunk_len], bjs[start : start + chunk_len]
+                bzs = windows[bi * size, bj * size]  # (nblocks, size + 1, size + 1)
+                is_mergeable[bi, bj] = _get_block_errors(bzs) <= tolerance
+        if block_lods is not None:
+            # Blocks within their level of detail, and so their children
+            block_lods = _get_block_children(block_lods, nbrows, nbcols).min(axis=2)
+            is_lod = block_lods >= level
+            lus = np.where(is_lod, _get_majorities(children_lus), lus)
+            is_mergeable |= is_lod
+        mergeables.append(is_mergeable)
+        block_lus.append(lus)
+        size *= 2
+
+    # Select leaf blocks, and mark the verts used by their corners
+    leaves = _get_quadtree_leaves(mergeables, nrows, ncols)
+    nlevels = len(leaves)
+    is_used = np.zeros(zs.shape, dtype=bool)
+    for level, (bis, bjs) in enumerate(leaves):
+        size = 2**level
+        i0, j0 = bis * size, bjs * size
+        is_used[i0, j0] = is_used[i0 + size, j0] = True
+        is_used[i0, j0 + size] = is_used[i0 + size, j0 + size] = True
+
+    # Renumber used verts in FDS notation (F90 indexes start from 1)
+    len_vcol = ncols + 1
+    vert_idxs = np.cumsum(is_used.ravel(), dtype=np.int64).astype(np.int32)
+    n_used = int(vert_idxs[-1])
+
+    # Triangulate the leaf blocks
+    faces, face_lus, center_ijs, center_zs = list(), list(), list(), list()
+    n_centers = 0
+    for level in range(nlevels):
+        size = 2**level
+        bis, bjs = leaves[level]
+        i0, j0 = bis * size, bjs * size
+        v00 = i0 * len_vcol + j0
+        v01, v10, v11 = v00 + size, v00 + size * len_vcol, v00 + size * (len_vcol + 1)
+        lus = block_lus[level][bis, bjs]
+        # Blocks without verts injected on their edges
+        if level:
+            is_fan = (
+                is_used[i0[:, None], j0[:, None] + np.arange(1, size)].any(axis=1)
+                | is_used[i0[:, None] + size, j0[:, None] + np.arange(1, size)].any(axis=1)
+                | is_used[i0[:, None] + np.arange(1, size), j0[:, None]].any(axis=1)
+                | is_used[i0[:, None] + np.arange(1, size), j0[:, None] + size].any(axis=1)
+            )
+        else:
+            is_fan = np.zeros(len(bis), dtype=bool)
+        q = ~is_fan
+        qfaces = np.empty((q.sum(), 2, 3), dtype=np.int32)
+        qfaces[:, 0, 0], qfaces[:, 0, 1], qfaces[:, 0, 2] = (
+            vert_idxs[v00[q]],
+            vert_idxs[v10[q]],
+            vert_idxs[v01[q]],
+        )  # 1st face
+        qfaces[:, 1, 0], qfaces[:, 1, 1], qfaces[:, 1, 2] = (
+            vert_idxs[v11[q]],
+            vert_idxs[v01[q]],
+            vert_idxs[v10[q]],
+        )  # 2nd face
+        faces.append(qfaces.reshape(-1, 3))
+        face_lus.append(np.repeat(lus[q], 2))
+        # Blocks with verts injected on their edges, fan around their center,
+        # boundary verts are listed counterclockwise from top left
+        fi0, fj0 = i0[is_fan, np.newaxis], j0[is_fan, np.newaxis]
+        nfan, edge = len(fi0), np.arange(size)
+        boundary = np.concatenate(
+            (
+                (fi0 + edge) * len_vcol + fj0,  # left, downward
+                (fi0 + size) * len_vcol + fj0 + edge,  # bottom, rightward
+                (fi0 + size - edge) * len_vcol + fj0 + size,  # right, upward
+                fi0 * len_vcol + fj0 + size - edge,  # top, leftward
+            ),
+            axis=1,
+        )  # (nfan, 4 * size)
+        is_boundary_used = is_used.ravel()[boundary]
+        boundary = boundary[is_boundary_used]  # compact, fan by fan
+        counts = is_boundary_used.sum(axis=1)
+        # Each boundary vert is followed by the next one of its fan, cyclically
+        nexts = np.arange(1, len(boundary) + 1)
+        ends = np.cumsum(counts)
+        nexts[ends - 1] = ends - counts
+        fans = np.empty((len(boundary), 3), dtype=np.int32)
+        fans[:, 0] = np.repeat(n_used + n_centers + np.arange(1, nfan + 1), counts)
+        fans[:, 1] = vert_idxs[boundary]
+        fans[:, 2] = fans[nexts, 1]
+        faces.append(fans)
+        face_lus.append(np.repeat(lus[is_fan], counts))
+        # Center verts on the block diagonals
+        fi0, fj0 = fi0[:, 0], fj0[:, 0]
+        center_ijs.append(np.column_stack((fi0 + size // 2, fj0 + size // 2)))
+        center_zs.append((zs[fi0 + size, fj0] + zs[fi0, fj0 + size]) / 2.0)
+        n_centers += nfan
+
+    # Collect
+    vijs = np.concatenate((np.argwhere(is_used), *center_ijs)).astype(np.int32)
+    vzs = np.concatenate((zs[is_used], *center_zs)).astype(zs.dtype, copy=False)
+    return vijs, vzs, np.concatenate(faces), np.concatenate(face_lus)
+
+
+def _get_block_errors(bzs):
+    """!
+    Get the max vertical error of block verts from their two faces.
+    The error of the edge verts is added, as a fan moves the faces by that much.
+    @param bzs: np.array() of block verts z, shape (nblocks, size + 1, size + 1).
+    @return np.array() of max errors, shape (nblocks,).
+    """
+    size = bzs.shape[1] - 1
+    t = np.linspace(0.0, 1.0, size + 1)
+    u, v = t[np.newaxis, :], t[:, np.newaxis]  # along cols, along rows
+    z00, z01 = bzs[:, :1, :1], bzs[:, :1, -1:]
+    z10, z11 = bzs[:, -1:, :1], bzs[:, -1:, -1:]
+    # 1st face (top left), and 2nd face (bottom right)
+    z_f1 = z00 + u * (z01 - z00) + v * (z10 - z00)
+    z_f2 = z11 + (1.0 - u) * (z10 - z11) + (1.0 - v) * (z01 - z11)
+    zs = np.where(u + v <= 1.0, z_f1, z_f2)
+    errors = np.abs(bzs - zs)
+    edge_errors = np.maximum(
+        np.maximum(errors[:, 0, :].max(axis=1), errors[:, -1, :].max(axis=1)),
+        np.maximum(errors[:, :, 0].max(axis=1), errors[:, :, -1].max(axis=1)),
+    )
+    return errors.max(axis=(1, 2)) + edge_errors
+
+
+# Terrain split by FDS MESH
+
+
+def get_parts(idxs, nparts):
+    """!
+    Get the items of each part, in their original order.
+    @param idxs: np.array() of part index of each item.
+    @param nparts: number of parts.
+    @return list of np.array() of item indexes, by part.
+    """
+    order = np.argsort(idxs, kind="stable")
+    bounds = np.searchsorted(idxs[order], np.arange(nparts + 1))
+    return [order[bounds[k] : bounds[k + 1]] for k in range(nparts)]
+
 
 # OBST terrain
 
 
+def get_merged_rects(keys):
+    """!
+    Greedy merge of adjacent equal matrix cells into rectangles,
+    by row runs first, then by stacking equal runs of following rows.
+    @param keys: 2D np.array() of integer cell keys, cells are merged if equal.
+    @return np.array() of rectangle first rows, last rows + 1, first cols, last cols + 1.
+    """
+    nrows, ncols = keys.shape
+
+    # Get row runs, a new run starts on key change or new row
+    is_start = np.ones(keys.shape, dtype=bool)
+    is_start[:, 1:] = keys[:, 1:] != keys[:, :-1]
+    starts = np.flatnonzero(is_start)
+    lens = np.diff(np.append(starts, keys.size))
+    rows, j0 = np.divmod(starts, ncols)
+    j1 = j0 + lens
+    run_keys = keys.ravel()[starts]
+
+    # Sort runs by col span, key, and row,
+    # then stack runs with same col span and key from consecutive rows
+    order = np.lexsort((rows, run_keys, j1, j0))
+    rows, j0, j1, run_keys = rows[order], j0[order], j1[order], run_keys[order]
+    is_new = np.ones(len(rows), dtype=bool)
+    is_new[1:] = (
+        (j0[1:] != j0[:-1])
+        | (j1[1:] != j1[:-1])
+        | (run_keys[1:] != run_keys[:-1])
+        | (rows[1:] != rows[:-1] + 1)
+    )
+    firsts = np.flatnonzero(is_new)
+    lasts = np.append(firsts[1:], len(rows)) - 1
+
+    # Get rectangles, ordered by first row and first col
+    i0, i1, j0, j1 = rows[firsts], rows[lasts] + 1, j0[firsts], j1[firsts]
+    order = np.lexsort((j0, i0))
+    return i0[order], i1[order], j0[order], j1[order]
+
+
+def get_rect_xbs(grid, i0, i1, j0, j1, bottoms, tops):
+    """!
+    Get the XBs of merged matrix rectangles, as building OBSTs and vegetation INITs.
+    @param grid: x0, y0, dx, dy of the matrix.
+    @param i0: np.array() of rectangle first rows.
+    @param i1: np.array() of rectangle last rows + 1.
+    @param j0: np.array() of rectangle first cols.
+    @param j1: np.array() of rectangle last cols + 1.
+    @param bottoms: np.array() of rectangle bottom z.
+    @param tops: np.array() of rectangle top z.
+    @return np.array() of XBs, shape (nrects, 6).
+    """
+    # The corners are halfway to the diagonal centers
+    x0, y0, dx, dy = grid
+    xbs = np.empty((len(i0), 6))
+    xbs[:, 0], xbs[:, 1] = x0 + (j0 - 0.5) * dx, x0 + (j1 - 0.5) * dx
+    xbs[:, 2], xbs[:, 3] = y0 + (i1 - 0.5) * dy, y0 + (i0 - 0.5) * dy
+    xbs[:, 4], xbs[:, 5] = bottoms, tops
+    return xbs
+
+
+def get_rect_lines(feedback, fmt, xbs, columns=()):
+    """!
+    Format the lines of XB rectangles in bulk, by chunks.
+    @param feedback: pyqgis feedback
+    @param fmt: printf-style format of a single line, the other columns first, then the XB.
+    @param xbs: np.array() of XBs, shape (nrects, 6).
+    @param columns: sequence of np.array() or LookupColumn other columns.
+    @return generator of str chunks of formatted lines.
+    """
+    return utils.get_formatted_lines(
+        feedback=feedback,
+        fmt=fmt,
+        columns=(*columns, *(xbs[:, k] for k in range(6))),
+    )
+
+
+def get_lod_blocks(zs, keys, lod_levels):
+    """!
+    Aggregate the matrix in quadtree blocks, up to their level of detail.
+    @param zs: np.array() of z, shape (nrows, ncols).
+    @param keys: np.array() of integer keys, shape (nrows, ncols).
+    @param lod_levels: np.array() of max quadtree level, shape (nrows, ncols).
+    @return np.array() of blocks first row, first col, size, mean z, and most frequent key,
+    ordered by first row and first col.
+    """
+    nrows, ncols = zs.shape
+
+    # Get mean z and most frequent key of blocks, level by level
+    mergeables, block_zs, block_keys = [None], [zs], [keys]  # level 0, cells
+    block_lods = lod_levels
+    size = 2
+    while size <= min(nrows, ncols):
+        level = len(mergeables)
+        nbrows, nbcols = nrows // size, ncols // size
+        block_lods = _get_block_children(block_lods, nbrows, nbcols).min(axis=2)
+        mergeables.append(block_lods >= level)
+        children_zs = _get_block_children(block_zs[-1], nbrows, nbcols)
+        block_zs.append(children_zs.mean(axis=2, dtype=np.float64))
+        children_keys = _get_block_children(block_keys[-1], nbrows, nbcols)
+        block_keys.append(_get_majorities(children_keys))
+        size *= 2
+
+    # Collect leaf blocks
+    i0, j0, sizes, bzs, bkeys = list(), list(), list(), list(), list()
+    for level, (bis, bjs) in enumerate(_get_quadtree_leaves(mergeables, nrows, ncols)):
+        size = 2**level
+        i0.append(bis * size)
+        j0.append(bjs * size)
+        sizes.append(np.full(len(bis), size))
+        bzs.append(block_zs[level][bis, bjs])
+        bkeys.append(block_keys[level][bis, bjs])
+    i0, j0 = np.concatenate(i0), np.concatenate(j0)
+    order = np.lexsort((j0, i0))
+    return (
+        i0[order],
+        j0[order],
+        np.concatenate(sizes)[order],
+        np.concatenate(bzs)[order],
+        np.concatenate(bkeys)[order],
+    )
+
+
 class OBSTTerrain(GEOMTerrain):
     def __init__(
         self,
         feedback,
         sampling_layer,
+        sampling_shape,
         utm_origin,
         landuse_layer,
         landuse_type,
         fire_layer,
-        path=None,  # unused
-        name=None,  # unused
+        path,
+        name,
+        cell_size=None,
+        merge_obsts=False,
+        snap_obsts=None,
+        geom_tolerance=None,  # unused
+        split_terrain=False,
+        text_nprocs=None,
+        memory_budget=None,
+        lod_distance=None,
+        utm_fire_layer=None,
+        sampling_arrays=None,
     ) -> None:
         self.feedback = feedback
         self.sampling_layer = sampling_layer
+        self.sampling_shape = sampling_shape
         self.utm_origin = utm_origin
         self.landuse_layer = landuse_layer
         self.landuse_type = landuse_type
         self.fire_layer = fire_layer
+        self.cell_size = cell_size
+        self.merge_obsts = merge_obsts
+        self.snap_obsts = snap_obsts  # None, "mean", or "max"
+        self.split_terrain = split_terrain
+        self.text_nprocs = text_nprocs
+        self.memory_budget = memory_budget  # in MB
+        self.lod_distance = lod_distance
+        self.utm_fire_layer = utm_fire_layer
+        self.sampling_arrays = sampling_arrays  # instead of sampling_layer
 
         # Init
+        self._init_scratch(path=path, name=name)
+        self._grid = None  # x0, y0, dx, dy of the centers, relative to origin
+        self._zs = None  # z of the centers, as _z_dtype
+        self._lus = None  # uint16 landuse of the centers
         self.min_z = 0.0
         self.max_z = 0.0
 
-        # Calc
+        # Calc, no ghost centers needed as the grid is regular
         self._init_matrix()
 
-        if self.feedback.isCanceled():
-            return {}
+    # Estimated size of the terrain arrays per quad face, in bytes:
+    # centers z, landuse, XBs, SURF indexes
+    _cell_nbytes = 8 + 2 + 48 + 4
 
-        self._inject_ghost_centers()
-        self._init_obsts()
+    # Centers z are float64, as they are the OBST tops
+    _z_dtype = np.float64
+
+    def get_matrix(self):
+        """Get the matrix of centers z, and its grid x0, y0, dx, dy relative to origin."""
+        return self._zs, self._grid
+
+    def set_domain(self, domain) -> None:
+        """Set the FDS domain, and init the terrain on it."""
+        self.domain = domain
+
+        lod_levels = None
+        if self.snap_obsts:
+            self._init_snapped_obsts()
+        else:
+            lod_levels = self._get_lod_levels()
+            if lod_levels is not None:
+                self._init_lod_obsts(lod_levels=lod_levels)
+            else:
+                self._init_obsts()
+
+        self._mesh_idxs = None
+        if self.split_terrain:
+            self._init_mesh_idxs()
+
+        if self.merge_obsts:
+            if self._obsts_shape is None:
+                self.feedback.pushInfo("OBSTs aggregated by level of detail, no merging.")
+            else:
+                self._merge_obsts()
+
+    # · centers of quad faces
+    # x OBST XB corners, halfway to the diagonal centers
+    #
+    #          ·   ·   ·  i-1
+    #            +---x p1
+    #          · | · | ·  i
+    #         p0 x---+
+    #          ·   ·   ·  i+1
+    #         j-1  j  j+1
 
     def _init_obsts(self):
-        """Get the formatted OBSTs from sampling layer."""
+        """Init the OBSTs XBs and SURF indexes from the matrix."""
         feedback = self.feedback
         feedback.pushInfo("Prepare OBSTs...")
         feedback.setProgress(0)
-        m = self._m
-        _obsts = list()
+        nrows, ncols = self._zs.shape
 
-        # Init
-        ncenters = m.shape[0] * m.shape[1]
-        partial_progress = ncenters // 100 or 1
-        surf_id_dict = self.landuse_type.surf_id_dict
-
-        # Skip last two rows and last two cols
-        min_z = self.min_z
-        for ip, idxs in enumerate(np.ndindex(m.shape[0] - 2, m.shape[1] - 2)):
-            i, j = idxs
-            p0 = (m[i + 2, j, :2] + m[i + 1, j + 1, :2]) / 2.0
-            p1 = (m[i + 1, j + 1, :2] + m[i, j + 2, :2]) / 2.0
-            z = m[i + 1, j + 1, 2]
-            lu = m[i + 1, j + 1, 3]
-            xb = tuple((p0[0], p1[0], p0[1], p1[1], min_z, z))
-            try:
-                surf_id = surf_id_dict[lu]
-            except ValueError:
-                self.feedback.reportError(f"Unknown landuse index <{lu}>, setting <0>.")
-                surf_id = surf_id_dict[0]
-            _obsts.append(
-                f"&OBST XB={xb[0]:.2f},{xb[1]:.2f},{xb[2]:.2f},{xb[3]:.2f},{xb[4]:.2f},{xb[5]:.2f} SURF_ID='{surf_id}' /"
+        # Fill the XBs by row
+        xbs = self._scratch.empty((nrows, ncols, 6), np.float64)
+        self._run_row_tiles(
+            func=_fill_obst_xbs,
+            arrays={"zs": self._zs, "xbs": xbs},
+            nrows=nrows,
+            grid=self._grid,
+            min_z=self.min_z,
+        )
+        self._xbs = xbs.reshape(-1, 6)
+        self._obsts_shape = xbs.shape[:2]
+
+        # Translate landuses into FDS SURF indexes, by row blocks
+        surf_idxs = self._scratch.empty((nrows, ncols), np.int32)
+        block_rows = self._block_rows or nrows
+        for r0 in range(0, nrows, block_rows):
+            r1 = min(r0 + block_rows, nrows)
+            surf_idxs[r0:r1] = self.landuse_type.get_surf_idxs(
+                self._lus[r0:r1], report=False
             )
-            if ip % partial_progress == 0:
-                self.feedback.setProgress(int(ip / ncenters * 100))
+        self.landuse_type.report_unknown_landuses()
+        self._surf_idxs = surf_idxs.ravel()
 
-        self._obsts = _obsts
+    def _init_snapped_obsts(self):
+        """Init the OBSTs XBs and SURF indexes aggregated on the FDS MESH cells."""
+        feedback = self.feedback
+        nrows, ncols = self._zs.shape
+        xs, ys = self._get_xys(np.arange(nrows), np.arange(ncols))
+
+        # Get the lattice of the FDS MESH cells, relative to origin
+        d = self.domain
+        x0, y0 = d.mesh_xb[0], d.mesh_xb[2]
+        dx = (d.mesh_xb[1] - d.mesh_xb[0]) / d.mesh_ijk[0]
+        dy = (d.mesh_xb[3] - d.mesh_xb[2]) / d.mesh_ijk[1]
+        nx, ny = d.nmesh_x * d.mesh_ijk[0], d.nmesh_y * d.mesh_ijk[1]
 
-    def get_fds(self) -> str:
-        """Get the FDS text."""
+        # Check
+        if dx <= self._grid[2]:
+            feedback.pushInfo("FDS MESH cells not coarser than the terrain, no aggregation.")
+            self._init_obsts()
+            return
+        feedback.pushInfo(f"Prepare OBSTs on FDS MESH cells ({self.snap_obsts} height)...")
+        feedback.setProgress(0)
+
+        # Get the MESH cell index of each matrix col and row,
+        # then the starts of the matrix blocks in the same MESH cell
+        ixs = np.clip(np.floor((xs - x0) / dx).astype(int), 0, nx - 1)
+        iys = np.clip(np.floor((ys - y0) / dy).astype(int), 0, ny - 1)
+        col_starts = np.flatnonzero(np.diff(ixs, prepend=-1))
+        row_starts = np.flatnonzero(np.diff(iys, prepend=-1))
+
+        def reduce_blocks(ufunc, a, dtype=None):
+            a = ufunc.reduceat(a, row_starts, axis=0, dtype=dtype)
+            return ufunc.reduceat(a, col_starts, axis=1, dtype=dtype)
+
+        # Aggregate heights, summing as float64
+        if self.snap_obsts == "max":
+            zs = reduce_blocks(np.maximum, self._zs)
+        else:
+            counts = np.outer(
+                np.diff(np.append(row_starts, nrows)),
+                np.diff(np.append(col_starts, ncols)),
+            )
+            zs = reduce_blocks(np.add, self._zs, dtype=np.float64) / counts
+
+        # Aggregate landuses by majority, ties to the first SURF index
+        surf_idxs = self.landuse_type.get_surf_idxs(self._lus)
+        major_surf_idxs = np.zeros(zs.shape, dtype=np.int32)
+        major_counts = np.zeros(zs.shape, dtype=np.int64)
+        for surf_idx in np.unique(surf_idxs):
+            counts = reduce_blocks(np.add, (surf_idxs == surf_idx).astype(np.int64))
+            is_major = counts > major_counts
+            major_surf_idxs[is_major] = surf_idx
+            major_counts[is_major] = counts[is_major]
+
+        # Fill the XBs by row, on the MESH cells
+        bxs, bys = ixs[col_starts], iys[row_starts]
+        xbs = np.empty((len(bys), len(bxs), 6))
+        xbs[:, :, 0], xbs[:, :, 1] = x0 + bxs * dx, x0 + (bxs + 1) * dx
+        xbs[:, :, 2] = (y0 + bys * dy)[:, np.newaxis]
+        xbs[:, :, 3] = (y0 + (bys + 1) * dy)[:, np.newaxis]
+        xbs[:, :, 4], xbs[:, :, 5] = self.min_z, zs
+        self._xbs = xbs.reshape(-1, 6)
+        self._obsts_shape = xbs.shape[:2]
+        self._surf_idxs = major_surf_idxs.ravel()
+        feedback.pushInfo(
+            f"{nrows * ncols} terrain cells aggregated into {len(self._xbs)} OBSTs."
+        )
+
+    def _init_lod_obsts(self, lod_levels):
+        """Init the OBSTs XBs and SURF indexes aggregated by level of detail."""
+        feedback = self.feedback
+        feedback.pushInfo("Prepare OBSTs by level of detail...")
+        nrows, ncols = self._zs.shape
+
+        # Aggregate heights and SURF indexes in quadtree blocks
+        i0, j0, sizes, zs, surf_idxs = get_lod_blocks(
+            zs=self._zs,
+            keys=self.landuse_type.get_surf_idxs(self._lus),
+            lod_levels=lod_levels,
+        )
+
+        # Fill the XBs, the corners are halfway to the diagonal centers
+        p0x, p0y = self._get_xys(i0 + sizes - 0.5, j0 - 0.5)
+        p1x, p1y = self._get_xys(i0 - 0.5, j0 + sizes - 0.5)
+        xbs = np.empty((len(i0), 6))
+        xbs[:, 0], xbs[:, 1] = p0x, p1x
+        xbs[:, 2], xbs[:, 3] = p0y, p1y
+        xbs[:, 4], xbs[:, 5] = self.min_z, zs
+        self._xbs = xbs
+        self._obsts_shape = None  # not a matrix
+        self._surf_idxs = surf_idxs
+        feedback.pushInfo(
+            f"{nrows * ncols} terrain cells aggregated into {len(xbs)} OBSTs."
+        )
+
+    def _init_mesh_idxs(self):
+        """Init the FDS MESH index of each OBST, by its center."""
+        xbs = self._xbs
+        self._mesh_idxs = self.domain.get_mesh_idxs(
+            (xbs[:, 0] + xbs[:, 1]) / 2.0, (xbs[:, 2] + xbs[:, 3]) / 2.0
+        )
+
+    def _merge_obsts(self):
+        """Merge adjacent OBSTs with same quantized height and SURF index."""
+        feedback = self.feedback
+        feedback.pushInfo("Merge OBSTs...")
+        nrows, ncols = self._obsts_shape
+        xbs = self._xbs.reshape(nrows, ncols, 6)
+        surf_idxs = self._surf_idxs.reshape(nrows, ncols)
+
+        # Quantize OBST heights to the FDS cell size
+        min_z, cell_size = self.min_z, self.cell_size
+        levels = np.rint((xbs[:, :, 5] - min_z) / cell_size).astype(np.int64)
+
+        # Get the rectangles of equal cells
+        n_surf_id = len(self.landuse_type.surf_id_dict)
+        keys = levels * n_surf_id + surf_idxs
+        if self._mesh_idxs is not None:  # do not merge across MESH boundaries
+            mesh_idxs = self._mesh_idxs.reshape(nrows, ncols)
+            keys = keys * self.domain.nmesh_x * self.domain.nmesh_y + mesh_idxs
+        i0, i1, j0, j1 = get_merged_rects(keys=keys)
+
+        # Build the merged XBs and SURF indexes
+        merged_xbs = np.empty((len(i0), 6))
+        merged_xbs[:, 0] = xbs[i0, j0, 0]
+        merged_xbs[:, 1] = xbs[i0, j1 - 1, 1]
+        merged_xbs[:, 2] = xbs[i1 - 1, j0, 2]
+        merged_xbs[:, 3] = xbs[i0, j0, 3]
+        merged_xbs[:, 4] = min_z
+        merged_xbs[:, 5] = min_z + levels[i0, j0] * cell_size
+        feedback.pushInfo(
+            f"{len(self._xbs)} OBSTs merged into {len(merged_xbs)} ({len(self._xbs) / len(merged_xbs):.1f}x reduction)."
+        )
+        self._xbs = merged_xbs
+        self._obsts_shape = None  # not a matrix anymore
+        self._surf_idxs = surf_idxs[i0, j0]
+        if self._mesh_idxs is not None:
+            self._mesh_idxs = mesh_idxs[i0, j0]
+
+    def _get_obsts(self, sel=None):
+        """Get the formatted OBSTs, or the selected ones, by chunks."""
+        surf_ids = np.array(tuple(self.landuse_type.surf_id_dict.values()), dtype=object)
+        xbs, surf_idxs = self._xbs, self._surf_idxs
+        if sel is not None:
+            xbs, surf_idxs = xbs[sel], surf_idxs[sel]
+        return utils.get_formatted_lines(
+            feedback=self.feedback,
+            fmt="&OBST XB=%.2f,%.2f,%.2f,%.2f,%.2f,%.2f SURF_ID='%s' /\n",
+            columns=(
+                xbs[:, 0],
+                xbs[:, 1],
+                xbs[:, 2],
+                xbs[:, 3],
+                xbs[:, 4],
+                xbs[:, 5],
+                utils.LookupColumn(values=surf_ids, idxs=surf_idxs),
+            ),
+            pool=self._pool,
+        )
+
+    def iter_fds(self):
+        """Get the FDS text, by chunks."""
         self.feedback.pushInfo(f"OBST terrain ready.")
-        obsts_str = "\n".join(self._obsts)
-        return f"""
-Terrain ({len(self._obsts)} OBSTs)
-{obsts_str}
+        if self._mesh_idxs is None:
+            yield f"""
+Terrain ({len(self._xbs)} OBSTs)
+"""
+            yield from self._get_obsts()
+            self.close()
+            return
+        # OBSTs are only grouped by MESH, in the same file,
+        # as all MPI processes read the whole FDS input file
+        nmesh_x, nmesh_y = self.domain.nmesh_x, self.domain.nmesh_y
+        yield f"""
+Terrain ({len(self._xbs)} OBSTs), grouped by MESH
+"""
+        for mesh_idx, sel in enumerate(get_parts(self._mesh_idxs, nmesh_x * nmesh_y)):
+            if not len(sel):
+                continue
+            j, i = divmod(mesh_idx, nmesh_x)
+            yield f"""
+Terrain of MESH {i},{j} ({len(sel)} OBSTs)
+"""
+            yield from self._get_obsts(sel)
+        self.close()
+
+
+# ZVALS terrain
+
+# The FDS GEOM terrain is defined by the verts z on a regular grid:
+# IJK are the numbers of verts along x and y, XB is the grid extent,
+# and ZVALS lists the verts z by rows from ymin to ymax, x varying fastest.
+# No verts or faces are built, and a single SURF_ID is used, the most frequent.
+# So the terrain split, GEOM simplification, and level of detail do not apply.
+# ZVALS are wrapped at a fixed number of values per line,
+# so that large grids do not exceed the FDS input line length.
+
+
+class ZVALSTerrain(GEOMTerrain):
+    # Estimated size of the terrain arrays per quad face, in bytes:
+    # centers z, ghost z, landuse, verts z, ZVALS
+    _cell_nbytes = 4 + 4 + 2 + 4 + 4
+
+    _zvals_per_line = 10
+
+    def set_domain(self, domain) -> None:
+        """Set the FDS domain, and init the terrain on it."""
+        self.domain = domain
+
+        self._report_ignored_options()
+
+        self._init_verts()
+
+        if self.feedback.isCanceled():
+            return
+
+        self._init_surf_idx()
+
+    def _report_ignored_options(self):
+        """Report the terrain options that do not apply to the ZVALS terrain."""
+        options = (
+            (self.split_terrain, "terrain split by FDS MESH"),
+            (self.geom_tolerance, "GEOM simplification vertical tolerance"),
+            (self.lod_distance, "terrain full resolution distance"),
+        )
+        for value, text in options:
+            if value:
+                self.feedback.reportError(f"ZVALS terrain, {text} ignored.")
+
+    def _init_surf_idx(self):
+        """Init the single SURF index, as the most frequent."""
+        nrows, ncols = self._lus.shape
+        counts = np.zeros(len(self.landuse_type.surf_id_dict), dtype=np.int64)
+        block_rows = self._block_rows or nrows
+        for r0 in range(0, nrows, block_rows):
+            surf_idxs = self.landuse_type.get_surf_idxs(
+                self._lus[r0 : r0 + block_rows], report=False
+            )
+            counts += np.bincount(surf_idxs.ravel(), minlength=len(counts))
+        self.landuse_type.report_unknown_landuses()
+        self._surf_idx = int(counts.argmax())
+        surf_id = tuple(self.landuse_type.surf_id_dict.values())[self._surf_idx]
+        nchanged = int(counts.sum() - counts[self._surf_idx])
+        if nchanged:
+            self.feedback.reportError(
+                f"ZVALS terrain has a single SURF_ID, <{surf_id}> is the most frequent: {nchanged} cells changed SURF_ID, fire layer bc included."
+            )
+        else:
+            self.feedback.pushInfo(f"ZVALS terrain has a single SURF_ID <{surf_id}>.")
+
+    def _get_zvals(self):
+        """Get the formatted ZVALS, by chunks."""
+        nrows, ncols = self._lus.shape
+
+        # Copy the verts z from ymin, by row blocks
+        vzs = self._vzs.reshape(nrows + 1, ncols + 1)[::-1]  # as view
+        zvals = self._scratch.empty(vzs.shape, vzs.dtype)
+        block_rows = self._block_rows or nrows + 1
+        for r0 in range(0, nrows + 1, block_rows):
+            zvals[r0 : r0 + block_rows] = vzs[r0 : r0 + block_rows]
+        zvals = zvals.ravel()
+
+        # Full lines, then the last line with no trailing comma
+        n = self._zvals_per_line
+        nlines = (len(zvals) - 1) // n
+        lines = zvals[: nlines * n].reshape(nlines, n)
+        yield from utils.get_formatted_lines(
+            feedback=self.feedback,
+            fmt="      " + ",".join(("%.2f",) * n) + ",\n",
+            columns=tuple(lines[:, k] for k in range(n)),
+            pool=self._pool,
+        )
+        last = zvals[nlines * n :]
+        yield "      " + (",".join(("%.2f",) * len(last)) % tuple(last))
+
+    def iter_fds(self):
+        """Get the FDS text, by chunks."""
+        nrows, ncols = self._lus.shape
+        x0, y0 = self._get_xys(-0.5, -0.5)  # top left vert
+        x1, y1 = self._get_xys(nrows - 0.5, ncols - 0.5)  # bottom right vert
+        surf_id = tuple(self.landuse_type.surf_id_dict.values())[self._surf_idx]
+        self.feedback.pushInfo(f"ZVALS terrain ready.")
+        yield f"""
+Terrain ({ncols + 1}·{nrows + 1} verts)
+&GEOM ID='Terrain'
+      SURF_ID='{surf_id}'
+      IS_TERRAIN=T EXTEND_TERRAIN=F
+      IJK={ncols + 1:d},{nrows + 1:d}
+      XB={min(x0, x1):.2f},{max(x0, x1):.2f},{min(y0, y1):.2f},{max(y0, y1):.2f}
+      ZVALS=
 """
+        yield from self._get_zvals()
+        yield " /"
+        self.close()
@@ -8,8 +8,32 @@ __copyright__ = "(C) 2020 by Emanuele Gissi"
 __revision__ = "$Format:%H$"  # replaced with git SHA1
 
 import os
-from qgis.core import QgsProcessingException
+import sys
+import struct
+import tempfile
+import multiprocessing
+import functools
+import collections
+import itertools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from qgis.core import (
+    QgsProcessingException,
+    QgsFeatureRequest,
+    QgsProject,
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    NULL,
+)
 from qgis.utils import iface
+from qgis.PyQt.QtCore import QPointF
+from qgis.PyQt.QtGui import QPolygonF
+
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
 
 
 # Text util
@@ -19,24 +43,321 @@ def shorten(text):
     return len(text) > 60 and f"...{text[-57:]}" or text or "none"
 
 
+def get_fds_texts(values, default):
+    """!
+    Get valid FDS quoted texts, as IDs and QUANTITYs.
+    Quotes are removed, empty or missing texts get the default.
+    @param values: np.array() of texts, None if missing.
+    @param default: text of the empty or missing values.
+    @return np.array() of str texts.
+    """
+    texts = np.empty(len(values), dtype=object)
+    for n, v in enumerate(values):
+        v = v is not None and str(v).replace("'", "").replace('"', "").strip()
+        texts[n] = v or default
+    return texts
+
+
 # Write to file
 
 
-def write_file(feedback, filepath, content):
-    """
-    Write a text to filepath.
+@contextlib.contextmanager
+def _report_file_errors(filepath):
+    """!
+    Report the file I/O errors as not writable filepath.
+    @param filepath: the written file.
     """
-    feedback.pushInfo(f"Save file: <{filepath}>")
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
     try:
-        with open(filepath, "w") as f:
-            f.write(content)
-    except Exception as err:
+        yield
+    except OSError as err:
         raise QgsProcessingException(
             f"File not writable to <{filepath}>, cannot proceed.\n{err}"
         )
 
 
+def write_file(feedback, filepath, content):
+    """
+    Write a text, or an iterable of text chunks, to filepath.
+    Write to a temporary file first, then rename it,
+    so that an interrupted export never leaves a partial file.
+    Errors while generating the chunks propagate unchanged.
+    A generator of chunks is always closed, also when canceled,
+    so that its cleanup runs.
+    """
+    feedback.pushInfo(f"Save file: <{filepath}>")
+    if isinstance(content, str):
+        content = (content,)
+    try:
+        _write_chunks(feedback, filepath, content)
+    finally:
+        if hasattr(content, "close"):
+            content.close()  # eg. a generator, not exhausted
+
+
+def _write_chunks(feedback, filepath, chunks):
+    """Write the text chunks to a temporary file, then rename it to filepath."""
+    tmp_filepath = f"{filepath}.tmp"
+    with _report_file_errors(filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        f = open(tmp_filepath, "w", buffering=2**20)
+    try:
+        try:
+            for chunk in chunks:  # eg. writing the bingeom, not a file error
+                if feedback.isCanceled():
+                    break
+                with _report_file_errors(filepath):
+                    f.write(chunk)
+        finally:
+            with _report_file_errors(filepath):
+                f.close()
+        with _report_file_errors(filepath):
+            if feedback.isCanceled():
+                os.remove(tmp_filepath)
+                feedback.pushInfo(f"Export canceled, file not saved: <{filepath}>")
+                return
+            os.replace(tmp_filepath, filepath)
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+
+# Bulk format to text
+
+
+def _format_lines(fmt, columns):
+    """!
+    Format lines in bulk.
+    @param fmt: printf-style format of a single line.
+    @param columns: sequence of np.array() or LookupColumn columns, one for each format specifier.
+    @return str of formatted lines.
+    """
+    # Interleave the columns, then format all the lines at once
+    nlines = len(columns[0])
+    values = np.empty((nlines, len(columns)), dtype=object)
+    for i, column in enumerate(columns):
+        values[:, i] = column[:]
+    return (fmt * nlines) % tuple(values.ravel())
+
+
+def get_formatted_lines(feedback, fmt, columns, chunk_len=100000, pool=None):
+    """!
+    Format lines in bulk, by chunks.
+    @param feedback: pyqgis feedback
+    @param fmt: printf-style format of a single line, eg. "&OBST XB=%.2f,%.2f /\\n".
+    @param columns: sequence of np.array() or LookupColumn columns, one for each format specifier.
+    @param chunk_len: max number of lines in a chunk.
+    @param pool: ProcessPool formatting the chunks, if None format in process.
+    @return generator of str chunks of formatted lines.
+    """
+    nlines = len(columns[0])
+    starts = range(0, nlines, chunk_len)
+    chunks = (
+        tuple(_get_column_chunk(c, start, start + chunk_len) for c in columns)
+        for start in starts
+    )
+    format_lines = functools.partial(_format_lines, fmt)
+    texts = pool.imap(format_lines, chunks) if pool else map(format_lines, chunks)
+    for start, text in zip(starts, texts):
+        yield text
+        feedback.setProgress(int(min(start + chunk_len, nlines) / nlines * 100))
+
+
+class LookupColumn:
+    """!
+    Column of values looked up by index, sliced without a full copy.
+    @param values: np.array() of values.
+    @param idxs: np.array() of value indexes.
+    """
+
+    def __init__(self, values, idxs) -> None:
+        self.values = values
+        self.idxs = idxs
+
+    def __len__(self):
+        return len(self.idxs)
+
+    def __getitem__(self, key):
+        return self.values[self.idxs[key]]
+
+
+def _get_column_chunk(column, start, stop):
+    """!
+    Get a chunk of a column, compact to be sent to a worker process.
+    @param column: np.array() or LookupColumn.
+    @param start: first line.
+    @param stop: last line + 1.
+    @return np.array(), or LookupColumn of the chunk indexes, looked up when formatted.
+    """
+    if isinstance(column, LookupColumn):
+        return LookupColumn(values=column.values, idxs=column.idxs[start:stop])
+    return np.asarray(column[start:stop])
+
+
+# Scratch arrays
+
+
+class ScratchArrays:
+    """!
+    Allocator of np.array(), backed by memory mapped scratch files
+    when requested, eg. when the memory budget is exceeded.
+    @param path: folder of the scratch files.
+    @param prefix: scratch files name prefix.
+    @param use_memmap: if False, allocate in memory.
+    """
+
+    def __init__(self, path, prefix, use_memmap=False) -> None:
+        self.path = path
+        self.prefix = prefix
+        self.use_memmap = use_memmap
+        self._filepaths = list()  # not removed yet
+
+    def empty(self, shape, dtype):
+        """Get a new array, with zeros if memory mapped."""
+        if not self.use_memmap or not np.prod(shape):
+            return np.empty(shape, dtype=dtype)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, filepath = tempfile.mkstemp(
+                prefix=f"{self.prefix}_", suffix=".scratch", dir=self.path
+            )
+            os.close(fd)
+            a = np.memmap(filepath, dtype=dtype, mode="w+", shape=shape)
+        except Exception as err:
+            raise QgsProcessingException(
+                f"Scratch file not writable to <{self.path}>, cannot proceed.\n{err}"
+            )
+        try:
+            os.remove(filepath)  # the mapping stays valid, on POSIX
+        except OSError:
+            self._filepaths.append(filepath)  # eg. on Windows, remove later
+        return a
+
+    def zeros(self, shape, dtype):
+        """Get a new array of zeros."""
+        if not self.use_memmap:
+            return np.zeros(shape, dtype=dtype)
+        return self.empty(shape, dtype)  # new files are zeroed
+
+    def close(self):
+        """Remove the remaining scratch files, if not in use."""
+        for filepath in tuple(self._filepaths):
+            try:
+                os.remove(filepath)
+                self._filepaths.remove(filepath)
+            except OSError:
+                pass
+
+
+# Row tiles
+
+
+def run_row_tiles(func, arrays, nrows, block_rows=None, **kwargs):
+    """!
+    Run func on row tiles, in process.
+    The fills are memory bound, so they run where the arrays are.
+    @param func: function func(arrays, r0, r1, **kwargs),
+    filling the r0:r1 rows of the output arrays.
+    @param arrays: dict of input and output np.array().
+    @param nrows: number of rows to split in tiles.
+    @param block_rows: max number of rows of each run, to limit memory.
+    @param kwargs: other func arguments.
+    """
+    block_rows = block_rows or nrows
+    for r0 in range(0, nrows, block_rows):
+        func(arrays, r0, min(r0 + block_rows, nrows), **kwargs)
+
+
+# Process pool
+
+# The pool is started when first needed, and reused until closed.
+# Tasks are submitted a few ahead of the consumer and their results
+# are returned in order, so the outputs are identical to the serial ones.
+
+
+def _get_mp_context():
+    """!
+    Get the multiprocessing context, spawning a Python interpreter.
+    @return multiprocessing context.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    # In QGIS, sys.executable may be the QGIS application itself
+    if not os.path.basename(sys.executable).lower().startswith("python"):
+        for name in ("pythonw.exe", "python.exe", "bin/python3"):
+            python = os.path.join(sys.exec_prefix, name)
+            if os.path.isfile(python):
+                ctx.set_executable(python)
+                break
+    return ctx
+
+
+class ProcessPool:
+    """!
+    Pool of worker processes, shared by the tasks of a stage.
+    If the pool fails, the remaining tasks are run serially in process.
+    @param feedback: pyqgis feedback
+    @param nprocs: number of processes.
+    """
+
+    def __init__(self, feedback, nprocs) -> None:
+        self.feedback = feedback
+        self.nprocs = nprocs
+        self._executor = None
+        self._is_broken = False
+
+    def _get_executor(self):
+        """Get the executor, started when first needed."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.nprocs, mp_context=_get_mp_context()
+            )
+        return self._executor
+
+    def imap(self, func, args):
+        """!
+        Map func on args, in the pool, lazily and in order.
+        @param func: picklable function func(arg).
+        @param args: iterable of picklable arguments.
+        @return generator of the results.
+        """
+        args = iter(args)
+        pending = collections.deque()  # [arg, future]
+        try:
+            while not self._is_broken:
+                try:
+                    # Keep a few tasks ahead of the consumer
+                    for arg in itertools.islice(args, 2 * self.nprocs - len(pending)):
+                        pending.append([arg, None])
+                        pending[-1][1] = self._get_executor().submit(func, arg)
+                    if not pending:
+                        return
+                    result = pending[0][1].result()  # raise worker errors
+                except Exception as err:
+                    self.feedback.reportError(
+                        f"Parallel processing failed, running serially.\n{err}"
+                    )
+                    self._is_broken = True
+                    break
+                pending.popleft()
+                yield result
+            # Serially, the failed and the remaining tasks
+            while pending:
+                arg, _ = pending.popleft()
+                yield func(arg)
+            for arg in args:
+                yield func(arg)
+        finally:
+            for _, future in pending:  # eg. closed by the consumer
+                if future is not None:
+                    future.cancel()
+
+    def close(self) -> None:
+        """Shut the worker processes down."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
 # The FDS bingeom file is written from Fortran90 like this:
 #      WRITE(731) INTEGER_ONE
 #      WRITE(731) N_VERTS,N_FACES,N_SURF_ID,N_VOLUS
@@ -45,23 +366,52 @@ def write_file(feedback, filepath, content):
 #      WRITE(731) SURFS(1:N_FACES)
 #      WRITE(731) VOLUS(1:4*N_VOLUS)
 
-import struct
-import numpy as np
 
+class ChunkedArray:
+    """!
+    Record data provided by chunks, with declared total length.
+    @param chunks: iterable of np.array() chunks, eg. a generator.
+    @param length: total number of items of all chunks.
+    """
 
-def _write_record(f, data):
+    def __init__(self, chunks, length) -> None:
+        self.chunks = chunks
+        self.length = length
+
+
+def _get_chunks(data):
+    """!
+    Get the chunks and total length of a record data.
+    @param data: np.array(), sequence or ChunkedArray of data.
+    @return iterable of chunks and their total length.
+    """
+    if isinstance(data, ChunkedArray):
+        return data.chunks, data.length
+    data = np.asarray(data)
+    return (data,), data.size
+
+
+def _write_record(f, data, dtype):
     """!
     Write a record to a binary unformatted sequential Fortran90 file.
+    Chunks are written straight from their buffers, in C order.
     @param f: open Python file object in 'wb' mode.
-    @param data: np.array() of data.
+    @param data: np.array(), sequence or ChunkedArray of data.
+    @param dtype: record data type.
     """
+    chunks, length = _get_chunks(data)
     # Calc start and end record tag
-    tag = len(data) * data.dtype.itemsize
-    # print(f"Write: record tag: {tag} dlen: {len(data)}\ndata: {data}")  # TODO log debug
+    tag = struct.pack("i", length * np.dtype(dtype).itemsize)
     # Write start tag, data, and end tag
-    f.write(struct.pack("i", tag))
-    data.tofile(f)
-    f.write(struct.pack("i", tag))
+    f.write(tag)
+    count = 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=dtype)  # no copy, if same dtype
+        chunk.tofile(f)
+        count += chunk.size
+    if count != length:
+        raise ValueError(f"Record length is {count} instead of {length}.")
+    f.write(tag)
 
 
 def write_bingeom(
@@ -76,6 +426,8 @@ def write_bingeom(
 ):
     """!
     Write FDS bingeom file.
+    Data are np.array() in FDS flat format (when flattened in C order),
+    sequences, or ChunkedArray, and are written without intermediate copies.
     @param feedback: pyqgis feedback
     @param filepath: destination filepath
     @param geom_type: GEOM type (eg. 1 is manifold, 2 is terrain)
@@ -86,35 +438,163 @@ def write_bingeom(
     @param fds_volus: volumes connectivity in FDS flat format, eg. (i0, j0, k0, w0, i1, ...)
     """
     feedback.pushInfo(f"Save bingeom file: <{filepath}>")
+    records = (
+        (np.array((geom_type,), dtype="int32"), "int32"),  # was 1 only
+        (
+            np.array(
+                (
+                    _get_chunks(fds_verts)[1] // 3,
+                    _get_chunks(fds_faces)[1] // 3,
+                    n_surf_id,
+                    _get_chunks(fds_volus)[1] // 4,
+                ),
+                dtype="int32",
+            ),
+            "int32",
+        ),
+        (fds_verts, "float64"),
+        (fds_faces, "int32"),
+        (fds_surfs, "int32"),
+        (fds_volus, "int32"),
+    )
     try:
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
         with open(filepath, "wb") as f:
-            _write_record(f, np.array((geom_type,), dtype="int32"))  # was 1 only
-            _write_record(
-                f,
-                np.array(
-                    (
-                        len(fds_verts) // 3,
-                        len(fds_faces) // 3,
-                        n_surf_id,
-                        len(fds_volus) // 4,
-                    ),
-                    dtype="int32",
-                ),
-            )
-            _write_record(f, np.array(fds_verts, dtype="float64"))
-            _write_record(f, np.array(fds_faces, dtype="int32"))
-            _write_record(f, np.array(fds_surfs, dtype="int32"))
-            _write_record(f, np.array(fds_volus, dtype="int32"))
+            for data, dtype in records:
+                _write_record(f, data, dtype)
     except Exception as err:
         raise QgsProcessingException(
             f"Bingeom file not writable to <{filepath}>, cannot proceed.\n{err}"
         )
 
 
+# Read vector layers
+
+
+def get_point_layer_arrays(
+    feedback, layer, utm_origin, field_names, utm_crs=None, transform_context=None
+):
+    """!
+    Read the point features of a layer into arrays, in one pass.
+    @param feedback: pyqgis feedback
+    @param layer: QgsVectorLayer of points.
+    @param utm_origin: QgsPoint of the origin.
+    @param field_names: list of field names to read, missing fields are all None.
+    @param utm_crs: QgsCoordinateReferenceSystem to transform to, if None the layer is already in the utm crs.
+    @param transform_context: QgsCoordinateTransformContext, if None of the current project.
+    @return np.array() of x, y relative to origin, and list of np.array() of field values.
+    """
+    fields = layer.fields()
+    idxs = [fields.indexOf(name) for name in field_names]
+    request = QgsFeatureRequest()
+    request.setSubsetOfAttributes([i for i in idxs if i != -1])
+
+    # Collect, converting NULL to None
+    nfeatures = layer.featureCount()
+    xs, ys = np.empty(nfeatures), np.empty(nfeatures)
+    columns = [np.full(nfeatures, None, dtype=object) for _ in field_names]
+    n = 0
+    for f in layer.getFeatures(request):
+        g = f.geometry()
+        if g.isNull() or g.isEmpty():
+            continue
+        p = g.vertexAt(0)  # first point, also of multipoints
+        xs[n], ys[n] = p.x(), p.y()
+        a = f.attributes()
+        for column, i in zip(columns, idxs):
+            if i != -1 and a[i] != NULL:
+                column[n] = a[i]
+        n += 1
+    if n < nfeatures:
+        feedback.pushInfo(f"{nfeatures - n} features without geometry skipped.")
+    xs, ys = xs[:n], ys[:n]
+    if utm_crs is not None:
+        xs, ys = get_transformed_xys(
+            xs, ys, layer.crs(), utm_crs, transform_context=transform_context
+        )
+    ox, oy = utm_origin.x(), utm_origin.y()
+    return xs - ox, ys - oy, [column[:n] for column in columns]
+
+
 # Geographic operations
 
 
+def get_transformed_xys(xs, ys, source_crs, destination_crs, transform_context=None):
+    """!
+    Transform coordinate arrays between crs, in one batched call.
+    The coordinate operation is the one chosen by the transform context,
+    as for the QGIS layer reprojection.
+    @param xs: np.array() of x, or longitudes.
+    @param ys: np.array() of y, or latitudes.
+    @param source_crs: QgsCoordinateReferenceSystem of the coordinates.
+    @param destination_crs: QgsCoordinateReferenceSystem of the result.
+    @param transform_context: QgsCoordinateTransformContext, if None of the current project.
+    @return np.array() of transformed x and y.
+    """
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    if source_crs == destination_crs or not len(xs):
+        return xs, ys
+    if transform_context is None:
+        transform_context = QgsProject.instance().transformContext()
+    if not pyproj:
+        ct = QgsCoordinateTransform(source_crs, destination_crs, transform_context)
+        return _get_qgis_transformed_xys(xs, ys, ct)
+    # The chosen operation, if any, is in the crs axis order
+    operation = transform_context.calculateCoordinateOperation(
+        source_crs, destination_crs
+    )
+    wkt_variant = QgsCoordinateReferenceSystem.WKT_PREFERRED  # WKT2, with datum
+    transform = _get_transform(
+        source_wkt=source_crs.toWkt(wkt_variant),
+        destination_wkt=destination_crs.toWkt(wkt_variant),
+        operation=operation,
+    )
+    if operation and source_crs.hasAxisInverted():
+        xs, ys = ys, xs
+    xs, ys = transform(xs, ys)
+    if operation and destination_crs.hasAxisInverted():
+        xs, ys = ys, xs
+    return xs, ys
+
+
+@functools.lru_cache(maxsize=8)
+def _get_transform(source_wkt, destination_wkt, operation):
+    """!
+    Get the PROJ batched transform function, cached by crs pair and operation.
+    @param source_wkt: WKT2 of the source crs.
+    @param destination_wkt: WKT2 of the destination crs.
+    @param operation: PROJ string of the chosen coordinate operation, if empty the best available.
+    @return function of x and y arrays, returning transformed x and y arrays.
+    """
+    if operation:
+        return pyproj.Transformer.from_pipeline(operation).transform
+    transformer = pyproj.Transformer.from_crs(
+        pyproj.CRS.from_wkt(source_wkt),
+        pyproj.CRS.from_wkt(destination_wkt),
+        always_xy=True,  # x, y order, as QGIS
+    )
+    return transformer.transform
+
+
+def _get_qgis_transformed_xys(xs, ys, ct):
+    """!
+    Transform coordinate arrays by QGIS, in one batched call.
+    The coordinates are shared with a QPolygonF, transformed in place.
+    @param xs: np.array() of x.
+    @param ys: np.array() of y.
+    @param ct: QgsCoordinateTransform.
+    @return np.array() of transformed x and y.
+    """
+    polygon = QPolygonF()
+    polygon.fill(QPointF(), len(xs))
+    buffer = polygon.data()  # sip.voidptr to the QPointF x, y doubles
+    buffer.setsize(2 * len(xs) * 8)
+    xys = np.frombuffer(buffer, dtype=np.float64).reshape(-1, 2)
+    xys[:, 0], xys[:, 1] = xs, ys
+    ct.transformPolygon(polygon)
+    return xys[:, 0].copy(), xys[:, 1].copy()
+
+
 def get_lonlat_url(wgs84_point):
     return f"http://www.openstreetmap.org/?mlat={wgs84_point.y()}&mlon={wgs84_point.x()}&zoom=12"
 
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""qgis2fds"""
+
+__author__ = "Emanuele Gissi"
+__date__ = "2020-05-04"
+__copyright__ = "(C) 2020 by Emanuele Gissi"
+__revision__ = "$Format:%H$"  # replaced with git SHA1
+
+import numpy as np
+from qgis.core import QgsProcessingException
+from . import utils
+from .terrain import get_merged_rects, get_rect_xbs, get_rect_lines
+
+
+# The vegetation points are snapped to the terrain matrix cells,
+# the tallest tree wins when a cell has many.
+# Crown bases and tops are above the local terrain z of the cell center,
+# and are quantized to the FDS cell size,
+# then adjacent cells with same PART_ID, base and top are merged into INITs.
+
+
+class Vegetation:
+    def __init__(
+        self,
+        feedback,
+        vegetation_layer,
+        utm_crs,
+        terrain,
+        cell_size,
+        transform_context=None,
+    ) -> None:
+        self.feedback = feedback
+        self.vegetation_layer = vegetation_layer
+        self.cell_size = cell_size
+        self._xbs = np.empty((0, 6))
+        self._part_ids, self._part_idxs = (), np.empty(0, dtype=np.int64)
+        self.max_z = terrain.max_z  # of terrain and crown tops
+
+        # Check
+        if not vegetation_layer:
+            feedback.pushInfo("No vegetation layer provided.")
+            return
+        if vegetation_layer.fields().indexOf("height") == -1:
+            raise QgsProcessingException(
+                f"No <height> field in vegetation layer <{vegetation_layer.name()}>, cannot proceed."
+            )
+        feedback.pushInfo("Prepare vegetation INITs...")
+
+        # Read the trees, transformed to utm in bulk
+        xs, ys, (part_ids, heights, bases) = utils.get_point_layer_arrays(
+            feedback=feedback,
+            layer=vegetation_layer,
+            utm_origin=terrain.utm_origin,
+            field_names=("part_id", "height", "crown_base"),
+            utm_crs=utm_crs,
+            transform_context=transform_context,
+        )
+        fds_part_ids = utils.get_fds_texts(part_ids, default="TREE")
+        nchanged = sum(
+            p is not None and str(p) != fds_p for p, fds_p in zip(part_ids, fds_part_ids)
+        )
+        if nchanged:
+            feedback.reportError(f"{nchanged} PART_IDs with quotes or empty, renamed.")
+        part_ids = fds_part_ids
+        heights[np.equal(heights, None)] = 0.0
+        bases[np.equal(bases, None)] = 0.0
+        heights, bases = heights.astype(np.float64), bases.astype(np.float64)
+
+        # Snap the trees to the matrix cells, in bulk
+        zs, (x0, y0, dx, dy) = terrain.get_matrix()
+        nrows, ncols = zs.shape
+        js = np.rint((xs - x0) / dx).astype(np.int64)
+        is_ = np.rint((ys - y0) / dy).astype(np.int64)
+        is_valid = (
+            (is_ >= 0) & (is_ < nrows) & (js >= 0) & (js < ncols) & (heights > bases)
+        )
+        if not is_valid.all():
+            feedback.pushInfo(
+                f"{np.count_nonzero(~is_valid)} trees outside the terrain or without crown skipped."
+            )
+        is_, js = is_[is_valid], js[is_valid]
+        heights, bases = heights[is_valid], bases[is_valid]
+        part_ids = part_ids[is_valid].astype(str)
+
+        # Quantize crown bases and tops to the FDS cell size,
+        # on the terrain z of the cells
+        min_z, ground_zs = terrain.min_z, zs[is_, js]
+        self._part_ids, part_idxs = np.unique(part_ids, return_inverse=True)
+        base_levels = np.floor((ground_zs + bases - min_z) / cell_size).astype(np.int64)
+        top_levels = np.rint((ground_zs + heights - min_z) / cell_size).astype(np.int64)
+        top_levels = np.maximum(top_levels, base_levels + 1)  # at least one cell
+
+        # Set the cell keys, the tallest tree of each cell wins
+        # (the last one of a cell, sorted by cell and top), empty cells have key 0
+        nbases, ntops = base_levels.max(initial=0) + 1, top_levels.max(initial=0) + 1
+        tree_keys = (part_idxs * nbases + base_levels) * ntops + top_levels + 1
+        cell_idxs = is_ * ncols + js
+        order = np.lexsort((top_levels, cell_idxs))
+        is_last = np.ones(len(order), dtype=bool)
+        is_last[:-1] = cell_idxs[order[1:]] != cell_idxs[order[:-1]]
+        winners = order[is_last]
+        keys = np.zeros((nrows, ncols), dtype=np.int64)
+        keys.ravel()[cell_idxs[winners]] = tree_keys[winners]  # unique cells
+
+        # Get the rectangles of equal vegetation cells
+        i0, i1, j0, j1 = get_merged_rects(keys=keys)
+        rect_keys = keys[i0, j0]
+        is_used = rect_keys > 0
+        i0, i1, j0, j1 = i0[is_used], i1[is_used], j0[is_used], j1[is_used]
+        rect_keys, top_levels = np.divmod(rect_keys[is_used] - 1, ntops)
+        self._part_idxs, base_levels = np.divmod(rect_keys, nbases)
+
+        # Build the XBs
+        self._xbs = xbs = get_rect_xbs(
+            grid=(x0, y0, dx, dy),
+            i0=i0,
+            i1=i1,
+            j0=j0,
+            j1=j1,
+            bottoms=min_z + base_levels * cell_size,
+            tops=min_z + top_levels * cell_size,
+        )
+        self.max_z = float(xbs[:, 5].max(initial=terrain.max_z))
+        feedback.pushInfo(
+            f"{len(heights)} trees on {np.count_nonzero(keys)} cells merged into {len(xbs)} INITs."
+        )
+
+    def get_comment(self) -> str:
+        return f"Vegetation layer: {self.vegetation_layer and self.vegetation_layer.name() or 'none'}"
+
+    def iter_fds(self):
+        """Get the FDS text, by chunks."""
+        if not len(self._xbs):
+            return
+        xbs = self._xbs
+        part_ids = ",".join(f"'{p}'" for p in self._part_ids)
+        yield f"""
+Vegetation ({len(xbs)} INITs), define the PARTs: {part_ids}
+"""
+        yield from get_rect_lines(
+            feedback=self.feedback,
+            fmt="&INIT PART_ID='%s' XB=%.2f,%.2f,%.2f,%.2f,%.2f,%.2f N_PARTICLES_PER_CELL=1 CELL_CENTERED=T /\n",
+            xbs=xbs,
+            columns=(
+                utils.LookupColumn(
+                    values=np.array(self._part_ids, dtype=object), idxs=self._part_idxs
+                ),
+            ),
+        )
@@ -42,18 +42,17 @@ class Wind:
                 f"Cannot import wind *.csv file: <{self.filepath}>:\n{err}"
             )
 
-    def get_fds(self) -> str:
-        result = f"""
+    def iter_fds(self):
+        yield f"""
 Wind
 &WIND SPEED=1., RAMP_SPEED_T='ws', RAMP_DIRECTION_T='wd' /\n"""
         if self._ws:
-            result += "\n".join(("\n".join(self._ws), "\n".join(self._wd)))
+            yield "\n".join(("\n".join(self._ws), "\n".join(self._wd)))
         else:
-            result += f"""! Example ramps for wind speed and direction
+            yield f"""! Example ramps for wind speed and direction
 &RAMP ID='ws', T=   0, F= 10. /
 &RAMP ID='ws', T= 600, F= 10. /
 &RAMP ID='ws', T=1200, F= 20. /
 &RAMP ID='wd', T=   0, F=315. /
 &RAMP ID='wd', T= 600, F=270. /
 &RAMP ID='wd', T=1200, F=360. /"""
-        return result